@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+'''
+Scaling benchmark for PangoNet at the size of future designation releases.
+
+Writes synthetic alias keys and lineage notes (deep alias chains, nested recombinants,
+withdrawn lineages), then times build, the ancestor/descendant closure, compress/uncompress,
+get_mrca, get_paths, distance_matrix, get_ancestry_matrix, the name trie and search
+(autocompletion), filter and every exporter on each. Results can be written as JSON or CSV
+and compared against a previous run, to catch regressions and scaling cliffs.
+
+    python benchmarks/bench_pangonet.py --sizes 10000 100000 500000 --output results.json
+    python benchmarks/bench_pangonet.py --sizes 10000 100000 500000 --baseline results.json
+
+The closure time per lineage should stay roughly flat as the network grows. With --window 0
+parents are drawn from every lineage, a random recursive tree whose depth grows
+logarithmically, the closure scaling case:
+
+    python benchmarks/bench_pangonet.py --sizes 50000 100000 200000 --window 0
+'''
+
+import argparse
+import csv
+import importlib.util
+import itertools
+import json
+import os
+import platform
+import random
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "pangonet"))
+from pangonet import PangoNet
+
+COLUMNS = ["lineages", "benchmark", "operations", "seconds", "us_per_op", "baseline_seconds", "ratio"]
+
+# Benchmarks of optional features, left out when their dependency is not installed
+OPTIONAL = {"get_ancestry_matrix": "scipy", "to_parquet": "pyarrow"}
+
+def alias_codes(prefix: str = "", exclude: str = "ABX"):
+    '''
+    Alias names in designation order (AA, AB, ..., ZZ, AAA, ...), skipping the first
+    letters in 'exclude': the top level lineages and the recombinants.
+    '''
+    for length in itertools.count(2 if not prefix else 1):
+        for letters in itertools.product(string.ascii_uppercase, repeat=length):
+            if not prefix and letters[0] in exclude:
+                continue
+            yield prefix + "".join(letters)
+
+def synthetic_inputs(
+        size: int,
+        outdir: str,
+        recombinant_rate: float = 0.01,
+        withdrawn_rate: float = 0.01,
+        window: int = 1000,
+        seed: int = 0,
+    ):
+    '''
+    Write an alias key and lineage notes with 'size' designated lineages below A and B.
+
+    window: New lineages pick their parent among the 'window' most recent ones, smaller
+            windows make deeper trees and longer alias chains. 0 picks among all of them.
+    '''
+    random.seed(seed)
+    aliases = {"A": "", "B": ""}
+    recombinants = {}
+    alias_names = alias_codes()
+    recombinant_names = alias_codes(prefix="X")
+
+    # compressed name -> uncompressed name, and the number of children of each lineage
+    uncompressed = {"A": "A", "B": "B"}
+    children = {"A": 0, "B": 0}
+    # Alias of each lineage that has been aliased, so its children can use it
+    aliased = {}
+    lineages = ["A", "B"]
+    withdrawn = []
+
+    def add_child(parent):
+        children[parent] += 1
+        pieces = parent.split(".")
+        # Pango names have at most four pieces, alias the parent before going deeper
+        if len(pieces) == 4:
+            if parent not in aliased:
+                alias = next(alias_names)
+                aliases[alias] = uncompressed[parent]
+                aliased[parent] = alias
+            lineage = f"{aliased[parent]}.{children[parent]}"
+        else:
+            lineage = f"{parent}.{children[parent]}"
+        uncompressed[lineage] = f"{uncompressed[parent]}.{children[parent]}"
+        children[lineage] = 0
+        return lineage
+
+    while len(lineages) < size:
+        recent = lineages[-window:]
+        # Recombinants draw their parents from anywhere, including other recombinants
+        # and their descendants, which nests them (ex. XBL from XBB.1.5.57)
+        if random.random() < recombinant_rate:
+            lineage = next(recombinant_names)
+            parents = list(dict.fromkeys([random.choice(recent), random.choice(lineages)]))
+            if len(parents) == 1: continue
+            recombinants[lineage] = parents
+            uncompressed[lineage] = lineage
+            children[lineage] = 0
+        else:
+            lineage = add_child(random.choice(recent))
+            # Withdrawn lineages stay in the lineage notes, but nothing is designated below them
+            if random.random() < withdrawn_rate:
+                withdrawn.append(lineage)
+                continue
+        lineages.append(lineage)
+
+    alias_key_path = os.path.join(outdir, f"alias_key_{size}.json")
+    with open(alias_key_path, "w") as outfile:
+        json.dump({**aliases, **recombinants}, outfile, indent=4)
+
+    lineage_notes_path = os.path.join(outdir, f"lineage_notes_{size}.txt")
+    with open(lineage_notes_path, "w") as outfile:
+        outfile.write("Lineage\tDescription\n")
+        for lineage in lineages:
+            outfile.write(f"{lineage}\tAlias of {uncompressed[lineage]}, synthetic lineage\n")
+        for lineage in withdrawn:
+            outfile.write(f"*{lineage}\tWithdrawn: synthetic lineage\n")
+
+    return alias_key_path, lineage_notes_path
+
+def time_benchmark(function, repeat: int = 1):
+    '''
+    Best wall time of 'repeat' calls to function.
+    '''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run_benchmarks(
+        size: int,
+        alias_key: str,
+        lineage_notes: str,
+        queries: int = 1000,
+        repeat: int = 1,
+        seed: int = 0,
+        skip: [str] = (),
+    ):
+    '''
+    Yields the benchmark name, number of operations and seconds for one network size.
+    The network is always built, skipping build only leaves out its timing.
+    '''
+    random.seed(seed)
+    pango = None
+    def build(compact=False):
+        nonlocal pango
+        pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes, compact=compact)
+
+    if "build_compact" not in skip:
+        yield "build_compact", 1, time_benchmark(lambda: build(compact=True), repeat)
+    seconds = time_benchmark(build, repeat)
+    if "build" not in skip:
+        yield "build", 1, seconds
+
+    lineages = list(pango.lineages)
+    uncompressed = [pango.network[lineage]["uncompressed"] for lineage in lineages]
+
+    def uncached(function, names):
+        pango.compress_cache.clear()
+        pango.uncompress_cache.clear()
+        function(names)
+
+    def paths():
+        # Nested recombinants multiply the paths to the root, keep the pairs that stay countable
+        pairs = []
+        for lineage in random.sample(lineages, min(len(lineages), queries * 10)):
+            ancestors = pango.get_ancestors(lineage)
+            if len(ancestors) == 0: continue
+            ancestor = random.choice(ancestors)
+            if pango.count_paths(lineage, ancestor) <= 1000:
+                pairs.append((lineage, ancestor))
+            if len(pairs) == queries: break
+        return pairs
+
+    def export(exporter):
+        with open(os.devnull, "w") as outfile:
+            exporter(outfile)
+
+    def export_path(exporter, name):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            exporter(os.path.join(tmpdir, name))
+
+    # name: (queries, function that times them), queries are only drawn for the benchmarks that run
+    benchmarks = {
+        "closure":         lambda: (pango.create_network(closure=False), lambda q: pango.create_closure(network=q)),
+        "compress":        lambda: (uncompressed, lambda q: uncached(pango.compress_many, q)),
+        "uncompress":      lambda: (lineages, lambda q: uncached(pango.uncompress_many, q)),
+        "get_mrca":        lambda: ([random.sample(lineages, random.randint(2, 5)) for _ in range(queries)], lambda q: [pango.get_mrca(g) for g in q]),
+        "get_paths":       lambda: (paths(), lambda q: [pango.get_paths(start=s, end=e) for s,e in q]),
+        "distance_matrix": lambda: ([random.sample(lineages, min(len(lineages), queries))], lambda q: pango.distance_matrix(q[0], condensed=True)),
+        "get_ancestry_matrix": lambda: ([None], lambda q: pango.get_ancestry_matrix()),
+        "create_trie":     lambda: ([None], lambda q: setattr(pango, "trie", pango.create_trie())),
+        "search":          lambda: ([l[:random.randint(1, len(l))] + "*" for l in random.sample(lineages, queries)], lambda q: [pango.search(p, limit=10) for p in q]),
+        "filter":          lambda: ([random.sample(lineages, len(lineages) // 10)], lambda q: pango.filter(q[0])),
+        "to_table":        lambda: ([None], lambda q: export(lambda f: pango.to_table(file=f))),
+        "to_newick":       lambda: ([None], lambda q: export(lambda f: pango.to_newick(extended=False, file=f))),
+        "to_newick_enwk":  lambda: ([None], lambda q: export(lambda f: pango.to_newick(extended=True, file=f))),
+        "to_mermaid":      lambda: ([None], lambda q: export(lambda f: pango.to_mermaid(file=f))),
+        "to_dot":          lambda: ([None], lambda q: export(lambda f: pango.to_dot(file=f))),
+        "to_json":         lambda: ([None], lambda q: export(lambda f: pango.to_json(file=f))),
+        "to_json_compact": lambda: ([None], lambda q: export(lambda f: pango.to_json(compact=True, file=f))),
+        "to_sqlite":       lambda: ([None], lambda q: export_path(pango.to_sqlite, "pango.sqlite")),
+        "to_parquet":      lambda: ([None], lambda q: export_path(pango.to_parquet, "pango.parquet")),
+    }
+    for name,benchmark in benchmarks.items():
+        if name in skip: continue
+        if name in OPTIONAL and importlib.util.find_spec(OPTIONAL[name]) is None:
+            print(f"Skipping {name}, it requires {OPTIONAL[name]}", file=sys.stderr)
+            continue
+        queries_list, function = benchmark()
+        yield name, len(queries_list), time_benchmark(lambda: function(queries_list), repeat)
+
+def read_results(path: str):
+    '''
+    Results of a previous run (JSON or CSV), as (lineages, benchmark) -> seconds.
+    '''
+    with open(path) as infile:
+        if path.endswith(".json"):
+            rows = json.load(infile)["results"]
+        else:
+            rows = list(csv.DictReader(infile))
+    return {(int(row["lineages"]), row["benchmark"]): float(row["seconds"]) for row in rows}
+
+def write_results(path: str, results: [dict], metadata: dict):
+    '''
+    Write results as JSON (with the run metadata) or CSV, depending on the extension.
+    '''
+    with open(path, "w", newline="") as outfile:
+        if path.endswith(".json"):
+            json.dump({**metadata, "results": results}, outfile, indent=4)
+            outfile.write("\n")
+        else:
+            writer = csv.DictWriter(outfile, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows(results)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark PangoNet on synthetic pango-like networks.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 50000, 100000], help="Number of lineages to test, ex. 10000 to 500000")
+    parser.add_argument("--recombinant-rate", type=float, default=0.01, help="Fraction of lineages that are recombinants")
+    parser.add_argument("--window", type=int, default=1000, help="Parents are chosen among this many recent lineages, smaller is deeper (0: all of them)")
+    parser.add_argument("--queries", type=int, default=1000, help="Number of get_mrca, get_paths and search queries, and of distance_matrix lineages")
+    parser.add_argument("--repeat", type=int, default=1, help="Repeat each benchmark, keeping the best time")
+    parser.add_argument("--skip", nargs="+", default=[], help="Benchmarks to leave out, ex. to_table to_json")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic inputs and queries")
+    parser.add_argument("--outdir", help="Keep the synthetic inputs in this directory (default: temporary)")
+    parser.add_argument("--output", help="Write the results to this JSON or CSV file")
+    parser.add_argument("--baseline", help="Compare against the results (JSON or CSV) of a previous run")
+    options = parser.parse_args()
+
+    baseline = read_results(options.baseline) if options.baseline else {}
+    metadata = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "options": {k:v for k,v in vars(options).items() if k not in ["output", "baseline"]},
+    }
+
+    tmpdir = tempfile.TemporaryDirectory() if not options.outdir else None
+    outdir = options.outdir or tmpdir.name
+    os.makedirs(outdir, exist_ok=True)
+
+    results = []
+    print("\t".join(COLUMNS))
+    for size in options.sizes:
+        alias_key, lineage_notes = synthetic_inputs(
+            size, outdir, recombinant_rate=options.recombinant_rate, window=options.window, seed=options.seed
+        )
+        for name, operations, seconds in run_benchmarks(
+                size, alias_key, lineage_notes, queries=options.queries, repeat=options.repeat, seed=options.seed, skip=options.skip
+            ):
+            before = baseline.get((size, name))
+            row = {
+                "lineages": size,
+                "benchmark": name,
+                "operations": operations,
+                "seconds": round(seconds, 6),
+                "us_per_op": round(seconds / max(operations, 1) * 1e6, 3),
+                "baseline_seconds": before if before is not None else "",
+                "ratio": round(seconds / before, 3) if before else "",
+            }
+            results.append(row)
+            print("\t".join(str(row[column]) for column in COLUMNS), flush=True)
+
+    if options.output:
+        write_results(options.output, results, metadata)
+    if tmpdir:
+        tmpdir.cleanup()
+
+if __name__ == "__main__":
+    main()
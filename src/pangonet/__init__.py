@@ -1 +1 @@
-from .pangonet import PangoNet,cli
\ No newline at end of file
+from .pangonet import PangoNet,Profile,QueryHandler,QueryService,annotate_file,atomic_output,cli,export_network
\ No newline at end of file
@@ -1,60 +1,776 @@
 #!/usr/bin/env python3
 
 import sys
-from collections import OrderedDict
+import bisect
+import csv
+import gzip
+import hashlib
+import io
+import itertools
+import mmap
+import struct
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
+from collections.abc import Mapping, Sequence
 import json
 import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import tracemalloc
 import copy
 import logging
+import urllib.error
+import urllib.parse
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from enum import Enum
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(asctime)s %(levelname)s:%(message)s')
+# Library messages, the cli sends them to stdout
+logger = logging.getLogger(__name__)
 
 # Github Download setup and credentials
 ALIAS_KEY_URL     = "https://api.github.com/repos/cov-lineages/pango-designation/contents/pango_designation/alias_key.json"
 LINEAGE_NOTES_URL = "https://api.github.com/repos/cov-lineages/pango-designation/contents/lineage_notes.txt"
 
+# Maximum number of lineage names remembered by compress and uncompress
+CACHE_SIZE = 100000
+
+# Binary snapshots written by PangoNet.save, bump the version when the layout changes
+SNAPSHOT_MAGIC   = b"PANGONET"
+SNAPSHOT_VERSION = 2
+
+# Flat files written by PangoNet.save_mmap, for sharing one network across processes
+MMAP_MAGIC   = b"PANGOMAP"
+MMAP_VERSION = 2
+
+# Tables written by PangoNet.to_sqlite and to_arrow: their columns (with SQLite types), 
+# and the columns indexed together in SQLite
+NETWORK_TABLES = OrderedDict([
+    ("nodes", (
+        [("lineage", "TEXT PRIMARY KEY"), ("uncompressed", "TEXT"), ("depth", "INTEGER"), ("recombinant", "INTEGER"), ("recombinant_descendant", "INTEGER")],
+        [["uncompressed"]],
+    )),
+    ("edges", (
+        [("parent", "TEXT"), ("lineage", "TEXT")],
+        [["parent", "lineage"], ["lineage", "parent"]],
+    )),
+    ("closure", (
+        [("ancestor", "TEXT"), ("lineage", "TEXT")],
+        [["ancestor", "lineage"], ["lineage", "ancestor"]],
+    )),
+])
+
 class Direction(Enum):
     ToRoot = 0
     ToTips = 1
     Unknown = 2
 
+class LRUCache(OrderedDict):
+    '''
+    Dictionary that evicts the least recently used key once it holds maxsize keys.
+    '''
+
+    def __init__(self, maxsize: int = CACHE_SIZE):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+class MappedStrings(Sequence):
+    '''
+    Read-only list of strings stored as one utf-8 blob, string i is blob[offsets[i]:offsets[i+1]].
+    '''
+
+    def __init__(self, blob: memoryview, offsets: memoryview):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return str(self.blob[self.offsets[i]:self.offsets[i + 1]], "utf-8")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+class MappedIds(Mapping):
+    '''
+    Read-only lookup of MappedStrings keys, found by binary search over a permutation that
+    sorts them. A key maps to its position, or ids[position] if there are ids, or to
+    values[ids[position]] if there are values too (ex. lineage names -> node id -> lineage).
+    '''
+
+    def __init__(self, keys: MappedStrings, order: memoryview, ids: memoryview = None, values: Sequence = None):
+        self.keys_strings = keys
+        self.order = order
+        self.ids = ids
+        # Not 'values', that would hide Mapping.values
+        self.mapped_values = values
+
+    def __getitem__(self, lineage: str):
+        if not isinstance(lineage, str):
+            raise KeyError(lineage)
+        target = lineage.encode("utf-8")
+        blob, offsets = self.keys_strings.blob, self.keys_strings.offsets
+        low, high = 0, len(self.order)
+        while low < high:
+            middle = (low + high) // 2
+            i = self.order[middle]
+            key = blob[offsets[i]:offsets[i + 1]].tobytes()
+            if key == target:
+                if self.ids is None:
+                    return i
+                return self.ids[i] if self.mapped_values is None else self.mapped_values[self.ids[i]]
+            elif key < target:
+                low = middle + 1
+            else:
+                high = middle
+        raise KeyError(lineage)
+
+    def __iter__(self):
+        return iter(self.keys_strings)
+
+    def __len__(self):
+        return len(self.keys_strings)
+
+class NodeView(Mapping):
+    '''
+    Read-only node of a CompactNetwork, with the same keys as a PangoNet.network node.
+    Values are looked up from the integer arrays when accessed.
+    '''
+
+    fields = ("uncompressed", "depth", "parents", "children", "ancestors", "descendants")
+
+    def __init__(self, graph, node: int):
+        self.graph = graph
+        self.node = node
+
+    def __getitem__(self, key):
+        graph, node = self.graph, self.node
+        if key == "uncompressed":
+            return graph.uncompressed[node]
+        elif key == "depth":
+            return graph.depth[node]
+        elif key == "parents":
+            return [graph.names[i] for i in graph.get_parents(node)]
+        elif key == "children":
+            return [graph.names[i] for i in graph.get_children(node)]
+        elif key == "ancestors":
+            return [graph.names[i] for i in graph.get_ancestors(node)]
+        elif key == "descendants":
+            return [graph.names[i] for i in graph.get_descendants(node)]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+class CompactNetwork(Mapping):
+    '''
+    Compact, read-only version of PangoNet.network.
+
+    Lineages are interned as integer node IDs and the parent/child edges are stored as
+    CSR (compressed sparse row) arrays: the neighbours of node i are 
+    indices[offsets[i]:offsets[i+1]]. Ancestors and descendants are walked on request 
+    rather than stored for every node. Lookups by lineage return a NodeView, so code 
+    written against the OrderedDict network keeps working.
+    '''
+
+    # Integer arrays that make up the network, used when saving snapshots
+    arrays = ("depth", "parents_offsets", "parents_indices", "children_offsets", "children_indices")
+
+    def __init__(self, network: OrderedDict = None):
+
+        # node id -> lineage, and lineage -> node id
+        self.names = []
+        self.ids = {}
+        self.uncompressed = []
+        self.depth = array("i")
+        self.parents_offsets  = array("i", [0])
+        self.parents_indices  = array("i")
+        self.children_offsets = array("i", [0])
+        self.children_indices = array("i")
+
+        if not network:
+            return
+
+        for lineage,info in network.items():
+            self.ids[lineage] = len(self.names)
+            self.names.append(lineage)
+            self.uncompressed.append(info["uncompressed"])
+            self.depth.append(info["depth"])
+
+        for lineage in self.names:
+            info = network[lineage]
+            self.parents_indices.extend(self.ids[p] for p in info["parents"])
+            self.parents_offsets.append(len(self.parents_indices))
+            self.children_indices.extend(self.ids[c] for c in info["children"])
+            self.children_offsets.append(len(self.children_indices))
+
+    def __getitem__(self, lineage: str):
+        return NodeView(self, self.ids[lineage])
+
+    def __contains__(self, lineage):
+        return lineage in self.ids
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_ancestors(self, node: int):
+        '''
+        Get ancestor node ids, in the same order as PangoNet.get_ancestors.
+        '''
+        return self.walk(node, self.parents_offsets, self.parents_indices)
+
+    def to_network(self):
+        '''
+        Convert back to an OrderedDict network of node dicts, without ancestors and descendants.
+        '''
+        nodes = []
+        for node,lineage in enumerate(self.names):
+            nodes.append({
+                "uncompressed": self.uncompressed[node],
+                "depth": self.depth[node],
+                "parents": [self.names[i] for i in self.get_parents(node)],
+                "children": [self.names[i] for i in self.get_children(node)],
+                "ancestors": [],
+                "descendants": [],
+            })
+        return OrderedDict(zip(self.names, nodes))
+
+    def get_children(self, node: int):
+        return self.children_indices[self.children_offsets[node]:self.children_offsets[node + 1]]
+
+    def get_descendants(self, node: int):
+        '''
+        Get descendant node ids, in the same order as PangoNet.get_descendants.
+        '''
+        return self.walk(node, self.children_offsets, self.children_indices)
+
+    def get_parents(self, node: int):
+        return self.parents_indices[self.parents_offsets[node]:self.parents_offsets[node + 1]]
+
+    def walk(self, node: int, offsets: array, indices: array):
+        '''
+        Depth-first (pre-order) walk from a node, visiting each node once.
+        '''
+
+        visited = []
+        seen = set()
+        # Push neighbours in reverse so they are popped in their original order
+        stack = list(reversed(indices[offsets[node]:offsets[node + 1]]))
+        while stack:
+            i = stack.pop()
+            if i in seen: continue
+            seen.add(i)
+            visited.append(i)
+            stack.extend(reversed(indices[offsets[i]:offsets[i + 1]]))
+        return visited
+
+class NetworkIndex:
+    '''
+    Reachability index over a CompactNetwork, answers "is a an ancestor of b?" in O(1).
+
+    Every node keeps its first parent as a spanning tree, numbered by a pre-order walk. 
+    A tree ancestor owns the contiguous range of pre-order numbers of its subtree.
+    Recombinants (multi-parent nodes) also have a row in a bitset of all their ancestors.
+    The ancestors of any node are its tree path up to the nearest recombinant, plus that 
+    recombinant's bitset row.
+
+    Binary lifting tables over the spanning tree answer most recent common ancestor 
+    queries in O(log depth) for lineages without recombinant ancestry.
+    '''
+
+    # Integer arrays that make up the index (plus the bits and up tables), used when saving snapshots
+    arrays = ("pre", "last", "nearest", "recombinants", "ancestors_offsets", "ancestors_indices", "tree_depth")
+
+    def __init__(self, graph: CompactNetwork, arrays: dict = None):
+
+        size = len(graph.names)
+        self.graph = graph
+
+        # Restore a saved index
+        if arrays:
+            for name in self.arrays:
+                setattr(self, name, arrays[name])
+            self.bits = arrays["bits"]
+            self.stride = (size + 7) // 8
+            self.up = [arrays[f"up_{k}"] for k in range(len([name for name in arrays if name.startswith("up_")]))]
+            return
+
+        # Spanning tree: first parent of each node
+        tree_children = [[] for _ in range(size)]
+        roots = []
+        for node in range(size):
+            parents = graph.get_parents(node)
+            if len(parents) == 0:
+                roots.append(node)
+            else:
+                tree_children[parents[0]].append(node)
+
+        # Pre-order numbers, and the last pre-order number inside each subtree
+        self.pre  = array("i", [0] * size)
+        self.last = array("i", [0] * size)
+        # Bitset row of the nearest recombinant tree ancestor (or self), -1 if none
+        self.nearest = array("i", [-1] * size)
+        self.recombinants = array("i")
+
+        counter = 0
+        for root in roots:
+            stack = [(root, False)]
+            while stack:
+                node, finished = stack.pop()
+                if finished:
+                    self.last[node] = counter - 1
+                    continue
+                self.pre[node] = counter
+                counter += 1
+                parents = graph.get_parents(node)
+                if len(parents) > 1:
+                    self.nearest[node] = len(self.recombinants)
+                    self.recombinants.append(node)
+                elif len(parents) == 1:
+                    self.nearest[node] = self.nearest[parents[0]]
+                stack.append((node, True))
+                stack.extend((child, False) for child in reversed(tree_children[node]))
+
+        # One row of bits per recombinant, bit i is set if node i is an ancestor.
+        # The ordered ancestors of each recombinant are kept too (as CSR), for get_mrca.
+        self.stride = (size + 7) // 8
+        self.bits = bytearray(self.stride * len(self.recombinants))
+        self.ancestors_offsets = array("i", [0])
+        self.ancestors_indices = array("i")
+        for row,node in enumerate(self.recombinants):
+            offset = row * self.stride
+            ancestors = graph.get_ancestors(node)
+            for ancestor in ancestors:
+                self.bits[offset + (ancestor >> 3)] |= 1 << (ancestor & 7)
+            self.ancestors_indices.extend(ancestors)
+            self.ancestors_offsets.append(len(self.ancestors_indices))
+
+        # Binary lifting: up[k][node] is the 2^k-th tree ancestor (roots point to themselves)
+        self.tree_depth = array("i", [0] * size)
+        parent = array("i", range(size))
+        for node in sorted(range(size), key=lambda node: self.pre[node]):
+            parents = graph.get_parents(node)
+            if len(parents) > 0:
+                parent[node] = parents[0]
+                self.tree_depth[node] = self.tree_depth[parents[0]] + 1
+        self.up = [parent]
+        max_depth = max(self.tree_depth) if size > 0 else 0
+        for _ in range(1, max(1, max_depth.bit_length())):
+            previous = self.up[-1]
+            self.up.append(array("i", (previous[previous[node]] for node in range(size))))
+
+    def get_ancestors(self, node: int):
+        '''
+        Ancestor node ids in the same order as PangoNet.get_ancestors: the tree path up to 
+        the nearest recombinant, followed by the ancestors of that recombinant.
+        '''
+        ancestors = []
+        row = self.nearest[node]
+        if row != -1:
+            start, end = self.ancestors_offsets[row], self.ancestors_offsets[row + 1]
+            if self.recombinants[row] == node:
+                return list(self.ancestors_indices[start:end])
+        parent = self.up[0]
+        while parent[node] != node:
+            node = parent[node]
+            ancestors.append(node)
+            if row != -1 and node == self.recombinants[row]:
+                ancestors.extend(self.ancestors_indices[start:end])
+                break
+        return ancestors
+
+    def get_lca(self, u: int, v: int):
+        '''
+        Lowest common ancestor of two node ids in the spanning tree, -1 if there is none.
+        '''
+        depth, up = self.tree_depth, self.up
+        if depth[u] < depth[v]:
+            u, v = v, u
+        difference = depth[u] - depth[v]
+        k = 0
+        while difference:
+            if difference & 1:
+                u = up[k][u]
+            difference >>= 1
+            k += 1
+        if u == v:
+            return u
+        for k in range(len(up) - 1, -1, -1):
+            if up[k][u] != up[k][v]:
+                u, v = up[k][u], up[k][v]
+        if up[0][u] != up[0][v]:
+            return -1
+        return up[0][u]
+
+    def get_mrca(self, nodes: [int]):
+        '''
+        Most recent common ancestor node ids, with the same semantics as PangoNet.get_mrca.
+        '''
+
+        if len(nodes) == 0:
+            return []
+        unique = dict.fromkeys(nodes)
+        # A lineage given more than once does not count as its own ancestor
+        repeated = set(node for node in unique if nodes.count(node) > 1) if len(unique) != len(nodes) else set()
+        tree = [node for node in unique if self.nearest[node] == -1]
+
+        # Only recombinant ancestry: shared ancestors must be input lineages or ancestors 
+        # of the first lineage, kept in that order like PangoNet.get_mrca. Small groups 
+        # intersect ancestor sets, larger groups test each candidate against the index.
+        if len(tree) == 0:
+            first = self.get_ancestors(nodes[0])
+            if len(unique) <= 4:
+                shared = None
+                for node in unique:
+                    ancestors = set(first) if node == nodes[0] else set(self.get_ancestors(node))
+                    ancestors.add(node)
+                    shared = ancestors if shared is None else shared & ancestors
+                shared -= repeated
+                shared = [a for a in unique if a in shared] + [a for a in first if a in shared and a not in unique]
+            else:
+                candidates = list(unique) + [a for a in first if a not in unique]
+                shared = [a for a in candidates if a not in repeated and self.is_common_ancestor(a, unique)]
+            if len(shared) == 0:
+                return []
+            depth = self.graph.depth
+            max_depth = max(depth[a] for a in shared)
+            return [a for a in shared if depth[a] == max_depth]
+
+        # Lineages without recombinant ancestry only have tree ancestors, so every shared 
+        # ancestor lies on the tree path above their LCA. Depth strictly decreases along 
+        # that path, so the first shared node on it is the answer.
+        mrca = tree[0]
+        for node in tree[1:]:
+            mrca = self.get_lca(mrca, node)
+            if mrca == -1:
+                return []
+        if len(tree) == len(unique) and len(repeated) == 0:
+            return [mrca]
+
+        for candidate in [mrca] + self.get_ancestors(mrca):
+            if candidate not in repeated and self.is_common_ancestor(candidate, unique):
+                return [candidate]
+        return []
+
+    def is_ancestor(self, ancestor: int, node: int):
+        '''
+        True if the node id 'ancestor' is a (strict) ancestor of the node id 'node'.
+        '''
+        if ancestor == node:
+            return False
+        if self.pre[ancestor] <= self.pre[node] <= self.last[ancestor]:
+            return True
+        row = self.nearest[node]
+        if row == -1:
+            return False
+        return bool(self.bits[row * self.stride + (ancestor >> 3)] & (1 << (ancestor & 7)))
+
+    def is_common_ancestor(self, ancestor: int, nodes: [int]):
+        '''
+        True if the node id 'ancestor' is an ancestor of (or one of) all the node ids.
+        '''
+        pre, last, nearest, bits, stride = self.pre, self.last, self.nearest, self.bits, self.stride
+        first, final = pre[ancestor], last[ancestor]
+        byte, mask = ancestor >> 3, 1 << (ancestor & 7)
+        for node in nodes:
+            if node == ancestor or first <= pre[node] <= final:
+                continue
+            row = nearest[node]
+            if row == -1 or not bits[row * stride + byte] & mask:
+                return False
+        return True
+
+class NameTrie:
+    '''
+    Trie over the dotted pieces of uncompressed lineage names, for prefix and wildcard 
+    queries (see PangoNet.search). Each node is [lineage, {piece: node}], ex. the node at
+    B -> 1 -> 1 -> 529 -> 2 holds BA.2, and everything designated below BA.2 is below it, 
+    whatever its alias. Nodes of withdrawn or undesignated names hold None.
+    '''
+
+    def __init__(self):
+        self.root = [None, {}]
+        # Aliases and first pieces (A, B, XBB, ...), sorted to find those starting with a prefix
+        self.first = []
+        # Alias or first piece -> the ones above it, ex. BQ -> [B, BA, BE]
+        self.above = {}
+        # Lineage -> recombinants it is a parent of
+        self.recombinants = {}
+
+    def add(self, uncompressed: str, lineage: str, node: list = None):
+        '''
+        Add a lineage at its uncompressed name, or at the pieces below node, and return its node.
+        '''
+        node = self.root if node is None else node
+        for piece in uncompressed.split("."):
+            children = node[1]
+            if piece not in children:
+                children[piece] = [None, {}]
+            node = children[piece]
+        node[0] = lineage
+        return node
+
+    def find(self, uncompressed: str):
+        '''
+        Node of an uncompressed name, None if nothing is designated at or below it.
+        '''
+        node = self.root
+        for piece in uncompressed.split("."):
+            node = node[1].get(piece)
+            if node is None:
+                return None
+        return node
+
+    def walk(self, node: list):
+        '''
+        Lineages at and below a node, parents before children.
+        '''
+        stack = [node]
+        while stack:
+            lineage, children = stack.pop()
+            if lineage is not None:
+                yield lineage
+            stack.extend(reversed(list(children.values())))
+
+class Profile:
+    '''
+    Wall time, network size and peak memory of each stage of a build or export.
+
+    Pass one to PangoNet(profile=...) to record its stages, ex. parse, aliases,
+    recombinants, parents, children, closure and depth. Peak memory is traced with
+    tracemalloc, which slows down the stages it measures, so it can be turned off.
+    '''
+
+    def __init__(self, memory: bool = True):
+        self.memory = memory
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name: str):
+        '''
+        Record a stage. Storing a network under "network" in the yielded record
+        also counts its nodes and edges once the stage is over.
+        '''
+        record = OrderedDict(stage=name)
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif self.memory and hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - start, 6)
+            if self.memory:
+                record["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            if tracing:
+                tracemalloc.stop()
+            network = record.pop("network", None)
+            if network is not None:
+                record["nodes"], record["edges"] = self.count(network)
+            self.stages.append(record)
+            logger.debug(f"Stage {name}: {record['seconds']}s")
+
+    def count(self, network):
+        '''
+        Number of lineages and parent-child edges in a network.
+        '''
+        if isinstance(network, CompactNetwork):
+            return len(network.names), len(network.parents_indices)
+        return len(network), sum(len(info["parents"]) for info in network.values())
+
+    def to_dict(self):
+        '''
+        Stages in the order they finished, and the total time spent in them.
+        '''
+        # Stages run in parallel are already counted by the stage that ran them
+        seconds = sum(s["seconds"] for s in self.stages if not s.get("parallel"))
+        return {"seconds": round(seconds, 6), "stages": self.stages}
+
+    def to_json(self, file=None):
+        '''
+        Stages as JSON, written to file if given.
+        '''
+        if file is None:
+            return json.dumps(self.to_dict(), indent=4)
+        json.dump(self.to_dict(), file, indent=4)
+
 class PangoNet:
 
-    def __init__(self, root: str = "root"):
+    def __init__(self, root: str = "root", profile: Profile = None):
         '''
         root: If not None, manually create top level node with this name
+        profile: If given, record the time, size and memory of each build stage in it
         '''
 
         self.aliases = dict()
+        self.aliases_reverse = dict()
+        # Compressed and uncompressed name of each lineage -> lineage, see resolve
+        self.names = dict()
+        # Uncompressed name pieces -> lineages, for wildcard queries, see search
+        self.trie = None
+        self.compress_cache = LRUCache()
+        self.uncompress_cache = LRUCache()
         self.hierarchy = OrderedDict()
         self.network = OrderedDict()
+        self.graph = CompactNetwork()
+        self.index = None
+        # sha256 of the alias key and lineage notes the network was built from
+        self.sources = dict()
+        # Memory-mapped file backing the network, see load_mmap
+        self.mapped = None
+        # Lineage notes path and line offsets of each lineage, see get_description
+        self.descriptions = None
+        self.profile = profile
         self.root = root        
         self.lineages = list()
 
-    def build(self, alias_key: str = None, lineage_notes: str = None, outdir: str = "."):
+    def annotate(self, lineages: [str], clades: [str] = None):
+        '''
+        Network context of each lineage: uncompressed name, parents, depth, recombinant and
+        reporting clade, the deepest of 'clades' that is the lineage or one of its ancestors.
+        Lineages that are not in the network get empty values.
+        '''
+
+        network = self.network
+
+        # Check the deepest clades first, keeping the names as given for reporting
+        reporting = [(clade, self.resolve(clade)) for clade in (clades or [])]
+        reporting = [(clade,lineage) for clade,lineage in reporting if lineage]
+        reporting.sort(key=lambda c: network[c[1]]["depth"], reverse=True)
+
+        annotations = dict()
+        for name in dict.fromkeys(lineages):
+            lineage = self.resolve(name)
+            if lineage is None:
+                annotations[name] = ["", "", "", "", ""]
+                continue
+            info = network[lineage]
+            clade = next((c for c,l in reporting if l == lineage or self.is_ancestor(l, lineage)), "")
+            annotations[name] = [
+                info["uncompressed"],
+                ", ".join(info["parents"]),
+                info["depth"],
+                lineage in self.recombinants,
+                clade,
+            ]
+
+        return [annotations[name] for name in lineages]
+
+    def build(
+            self,
+            alias_key: str = None,
+            lineage_notes: str = None,
+            outdir: str = ".",
+            compact: bool = False,
+            snapshot: str = None,
+            descriptions: bool = False,
+        ):
+        '''
+        compact:  If True, store the network as a CompactNetwork (integer ids and CSR arrays)
+                  instead of per-lineage dicts that hold their full ancestors and descendants.
+                  The CompactNetwork and its NetworkIndex (graph and index) are kept either
+                  way for the integer queries, so the default network holds both: its dicts
+                  make get_ancestors and get_descendants plain lookups, at the cost of memory
+                  that grows with the number of lineages times their depth.
+        snapshot: Path to a binary snapshot (see save). It is loaded if it matches the alias
+                  key and lineage notes, otherwise the network is built and saved there.
+        descriptions: If True, remember where each lineage is in the lineage notes, so its 
+                      description can be read on demand with get_description.
+        '''
 
         if outdir != "" and outdir != "." and not os.path.exists(outdir):
             os.makedirs(outdir)
-        # Download alias key if not provided
+        # Download alias key and lineage notes if not provided, both at the same time
+        downloads = []
         if not alias_key:
             alias_key_path = os.path.join(outdir, os.path.basename(ALIAS_KEY_URL))
-            self.download_file(url = ALIAS_KEY_URL, output = alias_key_path)
+            downloads.append((ALIAS_KEY_URL, alias_key_path))
         else:
             alias_key_path = alias_key
         
-        # Download lineage notes if not provided
         if not lineage_notes:
             lineage_notes_path = os.path.join(outdir, os.path.basename(LINEAGE_NOTES_URL))
-            self.download_file(url = LINEAGE_NOTES_URL, output = lineage_notes_path)
+            downloads.append((LINEAGE_NOTES_URL, lineage_notes_path))
         else:
             lineage_notes_path = lineage_notes
 
-        self.lineages     = self.parse_lineages(lineage_notes_path)
-        self.aliases      = self.parse_aliases(alias_key_path)
-        self.recombinants = self.parse_recombinants(alias_key_path)
-        self.network      = self.create_network()
+        if len(downloads) > 0:
+            with self.stage("download"), ThreadPoolExecutor(max_workers=len(downloads)) as pool:
+                list(pool.map(lambda download: self.download_file(*download), downloads))
+
+        # Reuse a snapshot built from the same input files
+        if snapshot and os.path.exists(snapshot):
+            try:
+                with self.stage("load") as stage:
+                    self.load(snapshot, alias_key=alias_key_path, lineage_notes=lineage_notes_path, compact=compact)
+                    stage["network"] = self.network
+                if descriptions:
+                    self.parse_lineages(lineage_notes_path, descriptions=True)
+                return self
+            except ValueError as e:
+                logger.info(f"Rebuilding snapshot: {e}")
+
+        with self.stage("parse"):
+            self.sources      = {"alias_key": hash_file(alias_key_path), "lineage_notes": hash_file(lineage_notes_path)}
+            self.lineages     = self.parse_lineages(lineage_notes_path, descriptions=descriptions)
+            alias_key_data    = self.parse_alias_key(alias_key_path)
+        with self.stage("aliases"):
+            self.aliases      = self.parse_aliases(alias_key_data)
+            self.aliases_reverse = self.create_aliases_reverse()
+        with self.stage("recombinants"):
+            self.recombinants = self.parse_recombinants(alias_key_data)
+        self.network      = self.create_network(closure=not compact)
+        with self.stage("names"):
+            self.names        = self.create_names()
+        # The name trie is only created on the first search, and the name caches that
+        # creating the network filled with every lineage are left to the queries
+        self.trie = None
+        self.compress_cache.clear()
+        self.uncompress_cache.clear()
+        with self.stage("compact") as stage:
+            self.graph        = CompactNetwork(self.network)
+            stage["network"] = self.graph
+        with self.stage("index"):
+            self.index        = NetworkIndex(self.graph)
+        if compact:
+            self.network = self.graph
+
+        if snapshot:
+            with self.stage("save"):
+                self.save(snapshot)
 
         return self
 
@@ -63,12 +779,17 @@ class PangoNet:
         Compress lineage name
         '''
 
+        alias = self.compress_cache.get(lineage)
+        if alias is not None:
+            return alias
+
         # uncompress fully first
         lineage_compress = self.uncompress(lineage)
         # Split nomenclature on '.'. ex. BC = B.1.1.529.1.1.1
         # [ 'B', '1', '1', '529', '1', '1', '1']
         lineage_split = lineage_compress.split(".")
         if len(lineage_split) <= 4:
+            self.compress_cache[lineage] = lineage
             return(lineage)
 
         # Pango lineages have a maximum of four pieces before they need to be aliased
@@ -78,19 +799,151 @@ class PangoNet:
             for i in range(1, length):
                 prefix = ".".join(lineage_split[0:length - i])
                 suffix = lineage_split[length - i:]   
-                # Stop at the first alias encounter
-                if prefix in self.aliases.values():
-                    prefix_alias = [alias for alias,lineage in self.aliases.items() if lineage == prefix]
-                    lineage_split = prefix_alias + suffix
+                # Stop at the first (longest) alias encounter
+                if prefix in self.aliases_reverse:
+                    lineage_split = [self.aliases_reverse[prefix]] + suffix
+                    break
+            # No alias exists for any prefix, nothing more can be compressed
+            else:
+                break
         # Join the split pieces back together with the '.'
         alias = ".".join(lineage_split)
+        self.compress_cache[lineage] = alias
         return alias
 
-    def create_network(self):
+    def compress_many(self, lineages: [str]):
+        '''
+        Compress a batch of lineage names, each distinct name is only compressed once.
+        '''
+
+        lineages = list(lineages)
+        aliases = {lineage:self.compress(lineage) for lineage in dict.fromkeys(lineages)}
+        return [aliases[lineage] for lineage in lineages]
+
+    def count_paths(self, start: str, end: str, network: OrderedDict = None):
+        '''
+        Count the paths between two lineages without enumerating them.
+        '''
+
+        if not network:
+            network = self.network
+        start, end = self.resolve(start) or start, self.resolve(end) or end
+
+        neighbours, reaches = self.get_path_steps(start=start, end=end, network=network)
+        if not neighbours:
+            return 1 if start == end else 0
+
+        # Number of paths from each lineage to the end, filled in post-order
+        counts = {end: 1}
+        stack = [start]
+        while stack:
+            lineage = stack[-1]
+            if lineage in counts:
+                stack.pop()
+                continue
+            steps = [n for n in neighbours(lineage) if reaches(n)]
+            pending = [n for n in steps if n not in counts]
+            if pending:
+                stack.extend(pending)
+            else:
+                counts[lineage] = sum(counts[n] for n in steps)
+                stack.pop()
+
+        return counts[start]
+
+    def create_aliases_reverse(self, aliases: dict = None):
+        '''
+        Create the inverted alias index (uncompressed lineage -> alias), used to compress names.
+
+        The compress and uncompress caches depend on the aliases, so they are reset as well.
+        '''
+
+        if aliases is None:
+            aliases = self.aliases
+
+        aliases_reverse = {}
+        for alias,lineage in aliases.items():
+            # Keep the first alias if a lineage was somehow aliased twice
+            if lineage not in aliases_reverse:
+                aliases_reverse[lineage] = alias
+
+        self.compress_cache.clear()
+        self.uncompress_cache.clear()
+
+        return aliases_reverse
+
+    def create_closure(self, network: OrderedDict = None):
         '''
-        root : If not None, manually create top level node with this name
+        Fill in the ancestors and descendants of every lineage.
+
+        The network is visited once in topological order, so that each lineage
+        extends the already computed closure of its parents (ancestors) or its
+        children (descendants). The ordering is identical to get_ancestors and
+        get_descendants, which deduplicate a depth-first walk.
         '''
-        logging.info(f"Creating network.")
+
+        if not network:
+            network = self.network
+
+        order = self.get_topological_order(network=network)
+
+        # Ancestors: parents are always processed before their children
+        for lineage in order:
+            parents = network[lineage]["parents"]
+            if len(parents) == 1:
+                parent = parents[0]
+                ancestors = [parent] + network[parent]["ancestors"]
+            else:
+                ancestors = []
+                for parent in parents:
+                    ancestors += [parent] + network[parent]["ancestors"]
+                # remove duplicates (python 3.7+ preserves order)
+                ancestors = list(dict.fromkeys(ancestors))
+            network[lineage]["ancestors"] = ancestors
+
+        # Descendants: children are always processed before their parents
+        for lineage in reversed(order):
+            children = network[lineage]["children"]
+            if len(children) == 1:
+                child = children[0]
+                descendants = [child] + network[child]["descendants"]
+            else:
+                descendants = []
+                for child in children:
+                    descendants += [child] + network[child]["descendants"]
+                descendants = list(dict.fromkeys(descendants))
+            network[lineage]["descendants"] = descendants
+
+        return network
+
+    def create_names(self, network: OrderedDict = None):
+        '''
+        Create the name index, from the compressed and uncompressed name of every lineage
+        to the lineage in the network. ex. JN.1 and B.1.1.529.2.86.1.1 -> JN.1
+        Partially compressed names (ex. BA.2.86.1.1) are uncompressed first, see resolve.
+        '''
+
+        if not network:
+            network = self.network
+
+        if isinstance(network, CompactNetwork):
+            nodes = zip(network.names, network.uncompressed)
+        else:
+            nodes = ((lineage, info["uncompressed"]) for lineage,info in network.items())
+
+        names = {}
+        for lineage,uncompressed in nodes:
+            names[lineage] = lineage
+            if uncompressed:
+                names[uncompressed] = lineage
+
+        return names
+
+    def create_network(self, closure: bool = True):
+        '''
+        closure : If False, skip storing the ancestors and descendants of each lineage
+        '''
+        logger.info(f"Creating network.")
 
         network = OrderedDict()
         # Manually add a root node according to params
@@ -101,79 +954,207 @@ class PangoNet:
         # ---------------------------------------------------------------------
         # Iteration #1: Parents
 
-        for lineage in self.lineages:
-
-            uncompressed = self.uncompress(lineage)
-            uncompressed_split = uncompressed.split(".")
+        with self.stage("parents") as stage:
+            for lineage in self.lineages:
 
-            # Option 1: Root node
-            # If we don't have a root yet, assign to first one encountered
-            # This functionality isn't used for SARS-CoV-2
-            if not root:
-                root = lineage
-                depth = 0
-                parents = []
-            # Option 2: Lookup recombinant parents
-            elif lineage in self.recombinants:
-                parents = self.recombinants[lineage]
-            else:
                 uncompressed = self.uncompress(lineage)
-                # Option 3: Top level node, A or B
-                if "." not in uncompressed:
-                    parents = [self.root]
+
+                # Option 1: Root node
+                # If we don't have a root yet, assign to first one encountered
+                # This functionality isn't used for SARS-CoV-2
+                if not root:
+                    root = lineage
+                    depth = 0
+                    parents = []
+                # Option 2: Lookup recombinant parents
+                # Option 3: Top level node, A or B, or parent from the uncompressed name
                 else:
-                    uncompressed_parent = uncompressed_split[0: (len(uncompressed_split) - 1)]
-                    parents = [self.compress(".".join(uncompressed_parent))]
+                    parents = self.create_parents(lineage)
 
-            network[lineage] = {"uncompressed": uncompressed, "depth": 0, "parents": parents, "children": [], "ancestors": [], "descendants": []}
+                network[lineage] = {"uncompressed": uncompressed, "depth": 0, "parents": parents, "children": [], "ancestors": [], "descendants": []}
+            stage["network"] = network
     
         # ---------------------------------------------------------------------
         # Iteratation #2: Children
 
-        for lineage,info in network.items():
-            for parent in info["parents"]:
-               network[parent]["children"].append(lineage)
+        with self.stage("children") as stage:
+            for lineage,info in network.items():
+                for parent in info["parents"]:
+                   network[parent]["children"].append(lineage)
+            stage["network"] = network
 
         # ---------------------------------------------------------------------
         # Iteratation #3: Descendants and Ancestors
     
-        for lineage in network:
-           network[lineage]["ancestors"] = self.get_ancestors(lineage=lineage, network=network)
-           network[lineage]["descendants"] = self.get_descendants(lineage=lineage, network=network)
+        if closure:
+            with self.stage("closure") as stage:
+                network = self.create_closure(network=network)
+                stage["network"] = network
 
         # ---------------------------------------------------------------------
-        # Iteratation #5: uncompressed aliases
+        # Iteratation #4: Depth
 
-        lineages = list(network.keys())
-        for lineage in lineages:
-            uncompressed = network[lineage]["uncompressed"]
-            if uncompressed and uncompressed != '' and uncompressed not in network:
-                network[uncompressed] = network[lineage]
+        with self.stage("depth") as stage:
+            # Walk down from the recombinants, so this also works without the closure
+            recombinants = set()
+            queue = deque(self.get_recombinants(network=network))
+            while queue:
+                lineage = queue.popleft()
+                if lineage in recombinants: continue
+                recombinants.add(lineage)
+                queue.extend(network[lineage]["children"])
+
+            # Parents come first, so their depth is always final before it is used
+            for lineage in self.get_topological_order(network=network):
+                info = network[lineage]
+                if lineage == self.root:
+                    depth = 0
+                elif lineage in recombinants:
+                    max_parent_depth = 0
+                    for parent in network[lineage]["parents"]:
+                        parent_depth = network[parent]["depth"]                 
+                        if parent_depth > max_parent_depth:
+                            max_parent_depth = parent_depth
+                    depth = max_parent_depth + 1
+                else:
+                    depth = len(info["uncompressed"].split("."))
+                network[lineage]["depth"] = depth
+            stage["network"] = network
 
-        # ---------------------------------------------------------------------
-        # Iteratation #4: Depth
+        return network
 
-        recombinants = self.get_recombinants(network=network, descendants=True)
+    def create_parents(self, lineage: str):
+        '''
+        Designated parents of a lineage: the recombinant parents from the alias key, or 
+        the parent in its uncompressed name (the root for top level lineages A and B).
+        '''
 
-        for lineage,info in network.items():
-            if lineage == self.root:
-                depth = 0
-            elif lineage in recombinants:
-                max_parent_depth = 0
-                for parent in network[lineage]["parents"]:
-                    parent_depth = network[parent]["depth"]                 
-                    if parent_depth > max_parent_depth:
-                        max_parent_depth = parent_depth
-                depth = max_parent_depth + 1
+        if lineage in self.recombinants:
+            return self.recombinants[lineage]
+        uncompressed_split = self.uncompress(lineage).split(".")
+        if len(uncompressed_split) == 1:
+            return [self.root]
+        return [self.compress(".".join(uncompressed_split[:-1]))]
+
+    def create_trie(self, network: OrderedDict = None):
+        '''
+        Create the name trie over the uncompressed names of every lineage, with the aliases
+        and the recombinants of each lineage from the alias key, see search.
+        '''
+
+        if not network:
+            network = self.network
+
+        if isinstance(network, CompactNetwork):
+            nodes = zip(network.names, network.uncompressed)
+        else:
+            nodes = ((lineage, info["uncompressed"]) for lineage,info in network.items())
+
+        # Lineages are added below their parent's node when it was added first
+        trie = NameTrie()
+        added = {}
+        for lineage,uncompressed in nodes:
+            if not uncompressed: continue
+            parent, _, piece = uncompressed.rpartition(".")
+            if parent in added:
+                added[uncompressed] = trie.add(piece, lineage, node=added[parent])
             else:
-                depth = len(info["uncompressed"].split("."))
-            network[lineage]["depth"] = depth
+                added[uncompressed] = trie.add(uncompressed, lineage)
+
+        # Aliases above each alias, from the nearest one (BE above BQ), shallowest first
+        trie.first = sorted(set(self.aliases).union(trie.root[1]))
+        expanded = {name:self.uncompress(name) for name in trie.first}
+        names = {uncompressed:name for name,uncompressed in expanded.items()}
+        for name in sorted(trie.first, key=lambda name: expanded[name].count(".")):
+            parent = expanded[name].rpartition(".")[0]
+            while parent and parent not in names:
+                parent = parent.rpartition(".")[0]
+            trie.above[name] = trie.above[names[parent]] + [names[parent]] if parent else []
+
+        for recombinant,parents in self.recombinants.items():
+            recombinant = self.resolve(recombinant)
+            if recombinant is None: continue
+            for parent in parents:
+                parent = self.resolve(parent)
+                if parent is not None:
+                    trie.recombinants.setdefault(parent, []).append(recombinant)
+
+        return trie
+
+    def distance_matrix(self, lineages: [str], condensed: bool = False):
+        '''
+        Pairwise network distances, the hops from two lineages up to their most recent common 
+        ancestor: depth(a) + depth(b) - 2 * depth(mrca). Returns a square matrix (list of rows),
+        or if condensed the upper triangle as one flat list (the order used by scipy's squareform).
+        Lineages without a common ancestor are an infinite distance apart.
+        '''
 
-        return network
+        network, ids, names, depth = self.network, self.graph.ids, self.graph.names, self.graph.depth
+        nodes = [ids[self.resolve(lineage) or lineage] for lineage in lineages]
+        unique = list(dict.fromkeys(nodes))
 
-    def download_file(self, url: str, output: str = None):
+        # Which of the lineages each ancestor (or the lineage itself) is shared by, as a bitmask
+        ancestors = []
+        shared = dict()
+        for row,node in enumerate(unique):
+            bit = 1 << row
+            if self.index:
+                node_ancestors = [node] + self.index.get_ancestors(node)
+            else:
+                node_ancestors = [node] + [ids[a] for a in network[names[node]]["ancestors"]]
+            for ancestor in node_ancestors:
+                shared[ancestor] = shared.get(ancestor, 0) | bit
+            ancestors.append(node_ancestors)
+
+        # Ancestors shared by exactly the same lineages are interchangeable, only the deepest 
+        # can be their MRCA. Ancestors of a single lineage are never an MRCA.
+        deepest = dict()
+        for ancestor,mask in shared.items():
+            if mask & (mask - 1) == 0:
+                continue
+            if mask not in deepest or depth[ancestor] > depth[deepest[mask]]:
+                deepest[mask] = ancestor
+
+        # Give each lineage a bitmask of its ancestors ordered by depth, so the highest bit
+        # two lineages have in common is the depth of their MRCA
+        columns = sorted(deepest.values(), key=lambda a: depth[a])
+        position = {ancestor:bit for bit,ancestor in enumerate(columns)}
+        masks = []
+        for node_ancestors in ancestors:
+            mask = 0
+            for ancestor in node_ancestors:
+                if ancestor in position:
+                    mask |= 1 << position[ancestor]
+            masks.append(mask)
+        twice = [float("-inf")] + [2 * depth[a] for a in columns]
+
+        order = {node:row for row,node in enumerate(unique)}
+        rows = [order[node] for node in nodes]
+        depths = [depth[node] for node in unique]
+        matrix = []
+        for i,row in enumerate(rows):
+            mask, d = masks[row], depths[row]
+            # A lineage is no distance from itself
+            matrix.append([
+                d + depths[r] - twice[(mask & masks[r]).bit_length()] if r != row else 0
+                for r in (rows[i + 1:] if condensed else rows)
+            ])
+
+        if condensed:
+            return [distance for distances in matrix for distance in distances]
+        return matrix
+
+    def download_file(self, url: str, output: str = None, timeout: float = 60, retries: int = 3, backoff: float = 1):
+        '''
+        Download a file, streamed to a temporary file that is then moved in place of output.
+        The ETag of the download is kept beside it (output.etag), so later calls only download
+        the file again if it changed. Failed requests are retried with exponential backoff.
+        '''
+
+        if not output:
+            output = os.path.basename(url)
 
-        logging.info(f"Downloading file: {output}")
+        logger.info(f"Downloading file: {output}")
 
         req = urllib.request.Request(url)
         # Try to add a github token if needed
@@ -181,17 +1162,51 @@ class PangoNet:
             github_token = os.environ.get('GITHUB_TOKEN')
             if github_token:
                 req.add_header('Authorization', f"Bearer {github_token}")
-            # If URL is actually a github api call
+            # If URL is actually a github api call, ask for the raw file content directly
+            # instead of a second request to its download_url
             if "api.github.com" in url:
-                response = urllib.request.urlopen(req)
-                url = json.loads(response.read())["download_url"]
-                req = urllib.request.Request(url)
-
-        # Download file
-        with open(output, 'w', encoding="utf-8") as outfile:
-            response = urllib.request.urlopen(req)
-            content = response.read().decode("utf-8", 'ignore')
-            outfile.write(content)
+                req.add_header('Accept', "application/vnd.github.raw+json")
+
+        # Only download the file again if it changed since the last download
+        etag_path = output + ".etag"
+        if os.path.exists(output) and os.path.exists(etag_path):
+            with open(etag_path) as infile:
+                req.add_header('If-None-Match', infile.read().strip())
+
+        for attempt in range(retries + 1):
+            try:
+                with urllib.request.urlopen(req, timeout=timeout) as response:
+                    etag = response.headers.get("ETag")
+                    outdir = os.path.dirname(os.path.abspath(output))
+                    with tempfile.NamedTemporaryFile(dir=outdir, prefix=".download.", delete=False) as outfile:
+                        try:
+                            shutil.copyfileobj(response, outfile)
+                        except BaseException:
+                            os.remove(outfile.name)
+                            raise
+                os.replace(outfile.name, output)
+                break
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    logger.info(f"File is up to date: {output}")
+                    return output
+                # Client errors won't go away by asking again, except rate limits
+                if attempt == retries or (e.code < 500 and e.code != 429):
+                    raise
+                error = e
+            except OSError as e:
+                if attempt == retries:
+                    raise
+                error = e
+            delay = backoff * 2 ** attempt
+            logger.warning(f"Download failed ({error}), retrying in {delay}s: {url}")
+            time.sleep(delay)
+
+        if etag:
+            with open(etag_path, 'w') as outfile:
+                outfile.write(etag)
+        elif os.path.exists(etag_path):
+            os.remove(etag_path)
 
         return output
 
@@ -204,21 +1219,37 @@ class PangoNet:
             network = self.network
         
         # Keep order of lineages in network
-        lineages = [l for l in network if l in lineages]
-        pango = copy.deepcopy(self)    
+        keep = set(self.resolve(l) or l for l in lineages)
+        lineages = [l for l in network if l in keep]
+        keep = set(lineages)
+
+        # Start from a shallow copy, the aliases, caches and sources are shared with
+        # this network, only the kept nodes are created anew.
+        pango = copy.copy(self)
 
         filtered_network = OrderedDict()        
         for lineage in lineages:
             info = network[lineage]
-            filtered_network[lineage] = copy.deepcopy(network[lineage])
-            filtered_network[lineage]["parents"]     = [l for l in info["parents"]     if l in lineages]
-            filtered_network[lineage]["children"]    = [l for l in info["children"]    if l in lineages]
-            filtered_network[lineage]["ancestors"]   = [l for l in info["ancestors"]   if l in lineages]
-            filtered_network[lineage]["descendants"] = [l for l in info["descendants"] if l in lineages]
+            filtered_network[lineage] = {
+                "uncompressed": info["uncompressed"],
+                "depth":        info["depth"],
+                "parents":      [l for l in info["parents"]     if l in keep],
+                "children":     [l for l in info["children"]    if l in keep],
+                "ancestors":    [l for l in info["ancestors"]   if l in keep],
+                "descendants":  [l for l in info["descendants"] if l in keep],
+            }
 
         pango.network = filtered_network
+        pango.names = pango.create_names()
+        # The filtered ancestors can skip over removed lineages, which the parent edges
+        # no longer reach, so membership falls back to the ancestors lists.
+        pango.graph = CompactNetwork(filtered_network)
+        pango.index = None
         # Update attributes
-        pango.recombinants = self.get_recombinants()
+        pango.lineages = [l for l in self.lineages if l in keep]
+        pango.recombinants = {l:parents for l,parents in self.recombinants.items() if l in keep}
+        # The name trie is created again on the first search
+        pango.trie = None
         return pango
 
 
@@ -229,6 +1260,11 @@ class PangoNet:
 
         if not network:
             network = self.network
+        lineage = self.resolve(lineage) or lineage
+
+        # Walk the arrays instead of recursing through node views
+        if isinstance(network, CompactNetwork):
+            return network[lineage]["ancestors"]
 
         ancestors = []
 
@@ -242,10 +1278,57 @@ class PangoNet:
         ancestors = list(dict.fromkeys(ancestors))
         return ancestors
 
+    def get_ancestry_matrix(self, include_self: bool = False, format: str = "csr"):
+        '''
+        Ancestry of every lineage as a sparse matrix: row i has a 1 in column j if lineage j
+        is an ancestor of lineage i (recombinants have all of their parental lineages). Rows 
+        and columns are the node ids of graph.names and graph.ids, which follow the network 
+        order. Returns the scipy.sparse matrix, the lineage of each row and column, and their
+        depths.
+
+        With sample counts per node id c, c @ matrix totals the samples below each clade, and
+        matrix[:, [graph.ids[clade] for clade in clades]] is an "is in clade" feature table.
+
+        include_self: If True, also set the diagonal, so each clade includes its own samples.
+        format: "csr" or "coo", the scipy.sparse format of the matrix. Requires scipy.
+        '''
+
+        if format not in ["csr", "coo"]:
+            raise ValueError(f"Unknown sparse matrix format: {format}, expected csr or coo")
+
+        try:
+            import numpy as np
+            from scipy import sparse
+        except ImportError:
+            raise ImportError("The ancestry matrix requires scipy: pip install scipy")
+
+        # One row per node, straight from the ancestors stored in the index. Filtered
+        # networks have no index, their ancestors lists skip over the removed lineages.
+        graph, index = self.graph, self.index
+        size = len(graph.names)
+        indptr, indices = array("i", [0]), array("i")
+        for node in range(size):
+            if index:
+                ancestors = index.get_ancestors(node)
+            else:
+                ancestors = [graph.ids[a] for a in self.network[graph.names[node]]["ancestors"]]
+            if include_self:
+                ancestors = ancestors + [node]
+            indices.extend(sorted(ancestors))
+            indptr.append(len(indices))
+
+        matrix = sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.int32), np.array(indices, dtype=np.int32), np.array(indptr, dtype=np.int32)),
+            shape=(size, size),
+        )
+        if format == "coo":
+            matrix = matrix.tocoo()
+        return matrix, graph.names, np.asarray(graph.depth, dtype=np.int32)
+
     def get_children(self, lineage: str, network : OrderedDict = None):
         if not network:
             network = self.network
-        return network[lineage]["children"]
+        return network[self.resolve(lineage) or lineage]["children"]
 
     def get_descendants(self, lineage: str, network : OrderedDict = None):
         '''
@@ -254,6 +1337,10 @@ class PangoNet:
 
         if not network:
             network = self.network
+        lineage = self.resolve(lineage) or lineage
+
+        if isinstance(network, CompactNetwork):
+            return network[lineage]["descendants"]
 
         descendants = []
         children = network[lineage]["children"]
@@ -266,6 +1353,22 @@ class PangoNet:
         descendants = list(dict.fromkeys(descendants))
         return descendants
 
+    def get_description(self, lineage: str):
+        '''
+        Get the description of a lineage from the lineage notes, see build(descriptions=True).
+        '''
+
+        if not self.descriptions:
+            raise ValueError("Descriptions were not kept, build the network with descriptions=True.")
+        lineage_notes_path, offsets = self.descriptions
+        lineage = self.resolve(lineage) or lineage
+        with open(lineage_notes_path, "rb") as table:
+            header = table.readline().decode("utf-8").strip().split("\t")
+            table.seek(offsets[lineage])
+            line = table.readline().decode("utf-8").rstrip("\r\n").split("\t")
+        description_i = header.index("Description")
+        return line[description_i] if description_i < len(line) else ""
+
     def get_mrca(self, lineages: [str], network: OrderedDict = None):
         '''
         Get most recent common ancestors
@@ -273,6 +1376,14 @@ class PangoNet:
 
         if not network: 
             network = self.network
+        lineages = [self.resolve(l) or l for l in lineages]
+
+        # Use the precomputed index when querying our own network
+        if network is self.network and self.index:
+            ids = self.graph.ids
+            names = {ids[l]:l for l in reversed(lineages)}
+            mrca = self.index.get_mrca([ids[l] for l in lineages])
+            return [names[a] if a in names else self.graph.names[a] for a in mrca]
 
         # Make a pile of all ancestors, include lineages themselves in list
         ancestors_count = {l:1 for l in lineages}
@@ -299,10 +1410,54 @@ class PangoNet:
 
         return ancestors
 
+    def get_mrca_many(self, groups: [[str]]):
+        '''
+        Get most recent common ancestors for many groups of lineages at once.
+        '''
+
+        if not self.index:
+            return [self.get_mrca(list(lineages)) for lineages in groups]
+
+        ids, names = self.graph.ids, self.graph.names
+        mrcas = []
+        for lineages in groups:
+            lineages = [self.resolve(l) or l for l in lineages]
+            inputs = {ids[l]:l for l in reversed(lineages)}
+            mrca = self.index.get_mrca([ids[l] for l in lineages])
+            mrcas.append([inputs[a] if a in inputs else names[a] for a in mrca])
+        return mrcas
+
     def get_parents(self, lineage: str, network : OrderedDict = None):
         if not network:
             network = self.network
-        return network[lineage]["parents"]
+        return network[self.resolve(lineage) or lineage]["parents"]
+
+    def get_path_steps(self, start: str, end: str, network: OrderedDict = None):
+        '''
+        Figure out which way to walk from start to end. Returns a function giving the next
+        lineages (parents or children), and a function testing if a lineage is on the way
+        to end. Both are None when start and end are the same or unrelated.
+        '''
+
+        if not network:
+            network = self.network
+        start, end = self.resolve(start) or start, self.resolve(end) or end
+
+        if start == end:
+            return (None, None)
+        # If end is an ancestor of start, we need to move towards the root
+        elif self.is_ancestor(end, start, network=network):
+            neighbours = lambda lineage: self.get_parents(network=network, lineage=lineage)
+            reaches = lambda lineage: lineage == end or self.is_ancestor(end, lineage, network=network)
+        # If end is a descendant of start, we need to move towards the tips
+        elif self.is_descendant(end, start, network=network):
+            neighbours = lambda lineage: self.get_children(network=network, lineage=lineage)
+            reaches = lambda lineage: lineage == end or self.is_descendant(end, lineage, network=network)
+        # Otherwise, unclear relationship for movement
+        else:
+            return (None, None)
+
+        return (neighbours, reaches)
 
     def get_paths(
             self, 
@@ -313,44 +1468,9 @@ class PangoNet:
             depth: int = 0,
         ):
         '''
+        Get all paths between two lineages, either towards the root or towards the tips.
         '''
-        if not network:
-            network = self.network
-
-        # Recursion bottom out, found our target
-        if start == end:
-            return [[start]]
-        
-        # If we don't know the direction yet
-        if direction == Direction.Unknown:
-            # If end is an ancestor of start, we need to move towards the root
-            if end in self.get_ancestors(network=network, lineage=start):
-                direction = Direction.ToRoot
-            # If end is a descendant of start, we need to move towards the tips
-            elif end in self.get_descendants(network=network, lineage=start):
-                direction = Direction.ToTips
-            # Otherwise, unclear relationship for movement, stop now
-            else:
-                return []
-
-        # Figure out where we should go next in our search
-        next_nodes = []    
-        if direction == Direction.ToRoot:
-            parents = self.get_parents(network=network, lineage=start)
-            next_nodes = [p for p in parents if p == end or end in self.get_ancestors(network=network, lineage=p)]
-        elif direction == Direction.ToTips:
-            children = self.get_children(network=network, lineage=start)
-            next_nodes = [c for c in children if c == end or end in self.get_descendants(network=network, lineage=c)]
-
-        # Recursively search and update paths
-        paths = []
-        for lineage in next_nodes:     
-            next_paths = self.get_paths(network=network, start=lineage, end=end, direction=direction, depth=depth + 1)
-            for p in next_paths:
-                p = [start] + p
-                paths.append(p)
-
-        return paths
+        return list(self.iter_paths(start=start, end=end, network=network, direction=direction))
 
     def get_recombinants(self, descendants=False, network: OrderedDict = None):
         '''
@@ -369,203 +1489,919 @@ class PangoNet:
         return recombinants
 
 
-    def parse_aliases(self, alias_key_path: str):
+    def get_tables(self, closure: bool = True, recombinant_descendants: set = None):
+        '''
+        Rows of the nodes, edges and (optionally) closure tables of the network, see 
+        NETWORK_TABLES. The closure table has one row per ancestor of each lineage. Rows
+        are produced as they are read, so large tables are never held in memory at once.
+
+        recombinant_descendants: Set of the recombinants and their descendants, if already
+                                 computed (ex. shared between exports, see export_network)
+        '''
+
+        network = self.network
+        if recombinant_descendants is None:
+            recombinant_descendants = set(self.get_recombinants(descendants=True))
+
+        tables = OrderedDict()
+        tables["nodes"] = (
+            (lineage, info["uncompressed"], info["depth"], lineage in self.recombinants, lineage in recombinant_descendants)
+            for lineage,info in network.items()
+        )
+        tables["edges"] = ((parent, lineage) for lineage,info in network.items() for parent in info["parents"])
+        if closure:
+            tables["closure"] = ((ancestor, lineage) for lineage,info in network.items() for ancestor in info["ancestors"])
+        return tables
+
+    def get_topological_order(self, network: OrderedDict = None):
+        '''
+        Get lineages ordered so that parents always come before their children.
+        '''
+
+        if not network:
+            network = self.network
+
+        in_degree = {lineage:len(info["parents"]) for lineage,info in network.items()}
+
+        # Kahn's algorithm, seeded in network order to keep the result stable
+        queue = deque([lineage for lineage,degree in in_degree.items() if degree == 0])
+        order = []
+        while queue:
+            lineage = queue.popleft()
+            order.append(lineage)
+            for child in network[lineage]["children"]:
+                in_degree[child] -= 1
+                if in_degree[child] == 0:
+                    queue.append(child)
+
+        if len(order) != len(in_degree):
+            cycle = [lineage for lineage,degree in in_degree.items() if degree > 0]
+            raise ValueError(f"Network contains a cycle involving lineages: {', '.join(cycle)}")
+
+        return order
+
+    def is_ancestor(self, ancestor: str, lineage: str, network: OrderedDict = None):
+        '''
+        True if 'ancestor' is an ancestor of 'lineage' (a lineage is not its own ancestor).
+        '''
+
+        ancestor, lineage = self.resolve(ancestor) or ancestor, self.resolve(lineage) or lineage
+        if network is None or network is self.network:
+            if self.index:
+                ids = self.graph.ids
+                return self.index.is_ancestor(ids[ancestor], ids[lineage])
+            network = self.network
+        return ancestor in network[lineage]["ancestors"]
+
+    def is_descendant(self, descendant: str, lineage: str, network: OrderedDict = None):
+        '''
+        True if 'descendant' is a descendant of 'lineage' (a lineage is not its own descendant).
+        '''
+
+        return self.is_ancestor(lineage, descendant, network=network)
+
+    def iter_lineage_notes(self, lineage_notes_path: str):
+        '''
+        Stream the lineage notes, yielding each lineage (withdrawn ones included) and the byte
+        offset of its line. Lines are only split up to the lineage column, descriptions are skipped.
+        '''
+
+        # The lineage notes file is a TSV table
+        with open(lineage_notes_path, "rb") as table:
+            # Locate the lineage column in the header
+            header = table.readline()
+            lineage_i = header.decode("utf-8").strip().split("\t").index("Lineage")
+            offset = len(header)
+            for line in table:
+                lineage = line.split(b"\t", lineage_i + 1)[lineage_i].strip().decode("utf-8")
+                yield lineage, offset
+                offset += len(line)
+
+    def iter_paths(
+            self, 
+            start: str, 
+            end: str, 
+            network : OrderedDict = None, 
+            direction: Direction = Direction.Unknown, 
+            limit: int = None,
+        ):
+        '''
+        Lazily generate paths between two lineages, in the same order as get_paths.
+        limit: Stop after this many paths.
+        '''
+
+        if not network:
+            network = self.network
+        start, end = self.resolve(start) or start, self.resolve(end) or end
+
+        if start == end:
+            yield [start]
+            return
+
+        neighbours, reaches = self.get_path_steps(start=start, end=end, network=network)
+        if not neighbours:
+            return
+        # An explicit direction must agree with the relationship between start and end
+        if direction == Direction.ToRoot and not self.is_ancestor(end, start, network=network):
+            return
+        elif direction == Direction.ToTips and not self.is_descendant(end, start, network=network):
+            return
+
+        # Depth-first search with an explicit stack, stack[i] walks the next steps of path[i]
+        found = 0
+        path = [start]
+        stack = [iter([n for n in neighbours(start) if reaches(n)])]
+        while stack:
+            lineage = next(stack[-1], None)
+            if lineage is None:
+                stack.pop()
+                path.pop()
+                continue
+            path.append(lineage)
+            if lineage == end:
+                yield list(path)
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+                path.pop()
+            else:
+                stack.append(iter([n for n in neighbours(lineage) if reaches(n)]))
+
+    def load(self, path: str, alias_key: str = None, lineage_notes: str = None, compact: bool = False):
+        '''
+        Load a network from a binary snapshot written by save.
+
+        alias_key, lineage_notes: If given, the snapshot must have been built from files with 
+                                  the same content, otherwise a ValueError is raised.
+        compact: If True, keep the network as a CompactNetwork.
+        '''
+
+        logger.info(f"Loading snapshot: {path}")
+
+        with open(path, "rb") as infile:
+            data = infile.read()
+
+        magic_size = len(SNAPSHOT_MAGIC)
+        if data[:magic_size] != SNAPSHOT_MAGIC:
+            raise ValueError(f"Not a pangonet snapshot: {path}")
+        version, info_size = struct.unpack_from("<II", data, magic_size)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Snapshot version {version} is not supported (expected {SNAPSHOT_VERSION}): {path}")
+        offset = magic_size + 8
+        info = json.loads(data[offset:offset + info_size])
+        offset += info_size
+
+        # Make sure the snapshot is not stale
+        for source,source_path in [("alias_key", alias_key), ("lineage_notes", lineage_notes)]:
+            if source_path and info["sources"][source] != hash_file(source_path):
+                raise ValueError(f"Snapshot {path} was not built from {source_path}")
+
+        strings = json.loads(zlib.decompress(data[offset:offset + info["strings"]]))
+        offset += info["strings"]
+        arrays = {}
+        for name,typecode,size in info["arrays"]:
+            values = array(typecode)
+            values.frombytes(data[offset:offset + size])
+            if info["byteorder"] != sys.byteorder:
+                values.byteswap()
+            arrays[name] = values
+            offset += size
+
+        self.root = strings["root"]
+        self.sources = info["sources"]
+        self.lineages = strings["lineages"]
+        self.aliases = strings["aliases"]
+        self.aliases_reverse = self.create_aliases_reverse()
+        self.recombinants = strings["recombinants"]
+
+        self.graph = CompactNetwork()
+        self.graph.names = strings["names"]
+        self.graph.uncompressed = strings["uncompressed"]
+        self.graph.ids = {lineage:node for node,lineage in enumerate(self.graph.names)}
+        for name in CompactNetwork.arrays:
+            setattr(self.graph, name, arrays[f"graph.{name}"])
+        index_arrays = {name[6:]:values for name,values in arrays.items() if name.startswith("index.")}
+        index_arrays["bits"] = bytearray(index_arrays["bits"])
+        self.index = NetworkIndex(self.graph, arrays=index_arrays)
+
+        if compact:
+            self.network = self.graph
+        else:
+            self.network = self.create_closure(network=self.graph.to_network())
+        self.names = self.create_names(network=self.graph)
+        self.trie = None
+
+        return self
+
+    def load_mmap(self, path: str):
+        '''
+        Open a flat file written by save_mmap, read-only and without copying the network.
+
+        The file is memory-mapped, and the CompactNetwork and NetworkIndex read their 
+        arrays and lineage names straight from the mapped buffer. Processes that open the
+        same file share one physical copy of the network through the page cache. Only the
+        aliases, recombinants and lineages list are parsed into python objects, the name
+        index is looked up in the mapped buffer too.
+        '''
+
+        logger.info(f"Mapping network: {path}")
+
+        with open(path, "rb") as infile:
+            buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(buffer)
+
+        magic_size = len(MMAP_MAGIC)
+        if view[:magic_size] != MMAP_MAGIC:
+            raise ValueError(f"Not a pangonet memory-mapped network: {path}")
+        version, info_size = struct.unpack_from("<II", buffer, magic_size)
+        if version != MMAP_VERSION:
+            raise ValueError(f"Memory-mapped network version {version} is not supported (expected {MMAP_VERSION}): {path}")
+        info = json.loads(view[magic_size + 8:magic_size + 8 + info_size].tobytes())
+        if info["byteorder"] != sys.byteorder:
+            raise ValueError(f"Memory-mapped network {path} was written with {info['byteorder']} endian byte order")
+
+        sections = {}
+        for name,(offset,typecode,count) in info["sections"].items():
+            size = count * array(typecode).itemsize
+            sections[name] = view[offset:offset + size].cast(typecode)
+
+        self.mapped = buffer
+        self.root = info["root"]
+        self.sources = info["sources"]
+        self.lineages = info["lineages"]
+        self.aliases = info["aliases"]
+        self.aliases_reverse = self.create_aliases_reverse()
+        self.recombinants = info["recombinants"]
+
+        self.graph = CompactNetwork()
+        self.graph.names = MappedStrings(sections["names"], sections["names_offsets"])
+        self.graph.uncompressed = MappedStrings(sections["uncompressed"], sections["uncompressed_offsets"])
+        self.graph.ids = MappedIds(self.graph.names, sections["names_order"])
+        keys = MappedStrings(sections["keys"], sections["keys_offsets"])
+        self.names = MappedIds(keys, sections["keys_order"], ids=sections["keys_ids"], values=self.graph.names)
+        for name in CompactNetwork.arrays:
+            setattr(self.graph, name, sections[f"graph.{name}"])
+        index_arrays = {name[6:]:values for name,values in sections.items() if name.startswith("index.")}
+        self.index = NetworkIndex(self.graph, arrays=index_arrays)
+        self.network = self.graph
+        # Created on the first search, so processes that never search don't copy the names
+        self.trie = None
+
+        return self
+
+    def parse_alias_key(self, alias_key_path: str):
+        '''
+        Load the alias key once, for both parse_aliases and parse_recombinants.
+        '''
+        with open(alias_key_path) as data:
+            return json.load(data)
+
+    def parse_aliases(self, alias_key):
         '''
         Extract the aliases from the hierarchy and removing recombinants because they 
         are not really aliases, so much as the alias key is a specification of their 
         parent-child relationships.
+
+        alias_key: Path to the alias key, or the alias key loaded by parse_alias_key
         '''
 
-        logging.info(f"Creating aliases.")
-        with open(alias_key_path) as data: 
-            alias_key = json.load(data)
-            aliases = {alias:lineage for alias,lineage in alias_key.items() if lineage != '' and type(lineage) != list}
+        logger.info(f"Creating aliases.")
+        if isinstance(alias_key, str):
+            alias_key = self.parse_alias_key(alias_key)
+        aliases = {alias:lineage for alias,lineage in alias_key.items() if lineage != '' and type(lineage) != list}
         return aliases
 
-    def parse_lineages(self, lineage_notes_path):
+    def parse_lineages(self, lineage_notes_path, descriptions: bool = False):
         '''
         Returns a list of designated lineages from the lineage notes.
+
+        descriptions: If True, remember where each lineage's line is in the lineage
+                      notes, so that get_description can read it later.
         '''
         lineages = []
-
-        # The lineage notes file is a TSV table
-        with open(lineage_notes_path) as table:
-            # Locate the lineage column in the header
-            header = table.readline().strip().split("\t")
-            lineage_i = header.index("Lineage")
-            for line in table:
-                lineage = line.strip().split("\t")[lineage_i]
-                # Skip over Withdrawn lineages (that start with '*')
-                if lineage.startswith('*'): continue
-                lineages.append(lineage)
+        # The byte offsets are only kept when descriptions are requested
+        offsets = {} if descriptions else None
+
+        for lineage,offset in self.iter_lineage_notes(lineage_notes_path):
+            # Skip over Withdrawn lineages (that start with '*')
+            if lineage.startswith('*'): continue
+            lineages.append(lineage)
+            if offsets is not None:
+                offsets[lineage] = offset
+
+        if descriptions:
+            self.descriptions = (lineage_notes_path, offsets)
         
         return lineages
 
-    def parse_recombinants(self, alias_key_path):
+    def parse_recombinants(self, alias_key):
         '''
         Returns recombinants and their parents.
+
+        alias_key: Path to the alias key, or the alias key loaded by parse_alias_key
         '''
+        if isinstance(alias_key, str):
+            alias_key = self.parse_alias_key(alias_key)
         recombinants = {}
-        with open(alias_key_path) as data:
-            alias_key = json.load(data)
-            for lineage, parents in alias_key.items():
-                if type(parents) != list: continue
-                parents_unique = []
-                for p in parents:
-                    p = p.replace("*", "")
-                    if p not in parents_unique:
-                        parents_unique.append(p)
-                recombinants[lineage] = parents_unique
+        for lineage, parents in alias_key.items():
+            if type(parents) != list: continue
+            parents_unique = []
+            for p in parents:
+                p = p.replace("*", "")
+                if p not in parents_unique:
+                    parents_unique.append(p)
+            recombinants[lineage] = parents_unique
         
         return recombinants
-              
 
-    def to_dot(self, network: OrderedDict = None):
+    def resolve(self, lineage: str):
+        '''
+        Lineage in the network with this compressed, uncompressed or partially compressed
+        name, None if there is none.
+        '''
+
+        resolved = self.names.get(lineage)
+        if resolved is None:
+            resolved = self.names.get(self.uncompress(lineage))
+        return resolved
+
+    def rollup(
+            self,
+            lineages: [str],
+            weights: [float] = None,
+            dates: [str] = None,
+            clades: [str] = None,
+            exclude: [str] = None,
+            frequency: bool = False,
+        ):
+        '''
+        Aggregate sample lineage calls up the network: each clade totals the samples (or weights)
+        of itself and all its descendants. Lineages can be compressed or uncompressed names, or
+        a numpy array of node ids (graph.ids) which is counted without a Python loop.
+        Samples under an 'exclude' clade are left out of every total.
+        Returns clade totals, or clade totals per date if dates are given.
+        '''
+
+        network = self.network
+
+        # Count each distinct lineage (and date) once, everything after only touches distinct values
+        try:
+            import numpy as np
+        except ImportError:
+            np = None
+
+        # Integer node ids (see graph.ids) are counted with numpy in one pass
+        if np is not None and isinstance(lineages, np.ndarray) and lineages.dtype.kind in "iu":
+            if dates is None:
+                periods, period_ids = [None], 0
+            else:
+                periods, period_ids = np.unique(np.asarray(dates), return_inverse=True)
+            keys = lineages * len(periods) + period_ids
+            totals = np.bincount(keys, weights=weights, minlength=len(self.graph.names) * len(periods))
+            counts = {}
+            for key in np.flatnonzero(totals):
+                node, period = divmod(int(key), len(periods))
+                period = None if dates is None else periods[period].item()
+                counts[(self.graph.names[node], period)] = totals[key].item()
+        else:
+            keys = lineages if dates is None else zip(lineages, dates)
+            if weights is None:
+                counts = Counter(keys)
+            else:
+                counts = Counter()
+                for key,weight in zip(keys, weights):
+                    counts[key] += weight
+            if dates is None:
+                counts = {(name, None):count for name,count in counts.items()}
+
+        # Resolve compressed and uncompressed names to lineages in the network
+        excluded = set(self.resolve(clade) for clade in exclude) if exclude else set()
+
+        totals    = dict()
+        samples   = Counter()
+        unknown   = Counter()
+        resolved  = dict()
+        for (name,period),count in counts.items():
+            if name not in resolved:
+                lineage = self.resolve(name)
+                resolved[name] = [lineage] + list(network[lineage]["ancestors"]) if lineage else None
+            contained = resolved[name]
+            if contained is None:
+                unknown[name] += count
+                continue
+            samples[period] += count
+            if excluded and not excluded.isdisjoint(contained):
+                continue
+            period_totals = totals.setdefault(period, Counter())
+            for lineage in contained:
+                period_totals[lineage] += count
+
+        if len(unknown) > 0:
+            logger.warning(f"Skipping {sum(unknown.values())} samples with lineages not in the network: {', '.join(list(unknown)[:10])}")
+
+        # Report the requested clades, otherwise every clade with samples in network order
+        rollups = OrderedDict()
+        for period in sorted(samples, key=lambda p: (p is not None, p)):
+            period_totals = totals.get(period, Counter())
+            if clades:
+                period_rollup = OrderedDict((clade, period_totals[self.resolve(clade)]) for clade in clades)
+            else:
+                period_rollup = OrderedDict((lineage, period_totals[lineage]) for lineage in network if lineage in period_totals)
+            # Frequencies are relative to all samples on that date, including excluded ones
+            if frequency:
+                for clade,total in period_rollup.items():
+                    period_rollup[clade] = total / samples[period]
+            rollups[period] = period_rollup
+
+        if dates is None:
+            return rollups.get(None, OrderedDict((clade, 0) for clade in clades or []))
+        return rollups
+
+    def save(self, path: str):
+        '''
+        Save the network as a versioned binary snapshot, that can be loaded back with load.
+
+        Layout: magic bytes, version and info length (uint32), info JSON (input file hashes 
+        and array sizes), zlib compressed JSON of the lineage names, then the raw integer 
+        arrays of the CompactNetwork and NetworkIndex.
+        '''
+
+        if not self.index:
+            raise ValueError("Only networks created by build or load can be saved.")
+
+        logger.info(f"Saving snapshot: {path}")
+
+        # Memory-mapped networks hold memoryviews and MappedStrings, copied to arrays and lists
+        arrays = OrderedDict()
+        for name in CompactNetwork.arrays:
+            arrays[f"graph.{name}"] = array("i", getattr(self.graph, name))
+        for name in NetworkIndex.arrays:
+            arrays[f"index.{name}"] = array("i", getattr(self.index, name))
+        arrays["index.bits"] = array("B", self.index.bits)
+        for k,up in enumerate(self.index.up):
+            arrays[f"index.up_{k}"] = array("i", up)
+
+        strings = {
+            "root": self.root,
+            "lineages": list(self.lineages),
+            "aliases": self.aliases,
+            "recombinants": self.recombinants,
+            "names": list(self.graph.names),
+            "uncompressed": list(self.graph.uncompressed),
+        }
+        strings = zlib.compress(json.dumps(strings).encode("utf-8"))
+
+        info = {
+            "sources": self.sources,
+            "byteorder": sys.byteorder,
+            "strings": len(strings),
+            "arrays": [[name, values.typecode, len(values) * values.itemsize] for name,values in arrays.items()],
+        }
+        info = json.dumps(info).encode("utf-8")
+
+        # Write to a temporary file first, so readers never see a partial snapshot
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(SNAPSHOT_MAGIC)
+            outfile.write(struct.pack("<II", SNAPSHOT_VERSION, len(info)))
+            outfile.write(info)
+            outfile.write(strings)
+            for values in arrays.values():
+                outfile.write(values.tobytes())
+        os.replace(tmp_path, path)
+
+        return path
+
+    def save_mmap(self, path: str):
+        '''
+        Write the node table, adjacency and reachability/MRCA index as a flat file that 
+        load_mmap can memory-map without deserializing.
+
+        Layout: magic bytes, version and info length (uint32), info JSON (aliases, 
+        recombinants, lineages and the offset/type/length of every section), then the 
+        sections, each aligned to 8 bytes. Lineage names are stored as utf-8 blobs with
+        offsets. Lookups by lineage binary search a sorted permutation of the lineages, and
+        lookups by compressed or uncompressed name (see create_names) one of both names.
+        '''
+
+        if not self.index:
+            raise ValueError("Only networks created by build or load can be saved.")
+
+        logger.info(f"Saving memory-mapped network: {path}")
+
+        sections = OrderedDict()
+        for name,strings in [("names", self.graph.names), ("uncompressed", self.graph.uncompressed), ("keys", list(self.names))]:
+            encoded = [string.encode("utf-8") for string in strings]
+            offsets = array("i", [0])
+            for string in encoded:
+                offsets.append(offsets[-1] + len(string))
+            sections[name] = array("B", b"".join(encoded))
+            sections[f"{name}_offsets"] = offsets
+            if name != "uncompressed":
+                sections[f"{name}_order"] = array("i", sorted(range(len(encoded)), key=lambda i: encoded[i]))
+        sections["keys_ids"] = array("i", (self.graph.ids[lineage] for lineage in self.names.values()))
+        for name in CompactNetwork.arrays:
+            sections[f"graph.{name}"] = array("i", getattr(self.graph, name))
+        for name in NetworkIndex.arrays:
+            sections[f"index.{name}"] = array("i", getattr(self.index, name))
+        sections["index.bits"] = array("B", self.index.bits)
+        for k,up in enumerate(self.index.up):
+            sections[f"index.up_{k}"] = array("i", up)
+
+        # Work out where each section goes, the info block size depends on the offsets
+        # so iterate until it stops changing.
+        info = {
+            "root": self.root,
+            "sources": self.sources,
+            "byteorder": sys.byteorder,
+            "lineages": list(self.lineages),
+            "aliases": self.aliases,
+            "recombinants": self.recombinants,
+            "sections": {},
+        }
+        info_bytes = b""
+        while True:
+            offset = len(MMAP_MAGIC) + 8 + len(info_bytes)
+            for name,values in sections.items():
+                offset += -offset % 8
+                info["sections"][name] = [offset, values.typecode, len(values)]
+                offset += len(values) * values.itemsize
+            encoded = json.dumps(info).encode("utf-8")
+            finished = len(encoded) == len(info_bytes)
+            info_bytes = encoded
+            if finished:
+                break
+
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(MMAP_MAGIC)
+            outfile.write(struct.pack("<II", MMAP_VERSION, len(info_bytes)))
+            outfile.write(info_bytes)
+            for name,values in sections.items():
+                outfile.write(b"\0" * (info["sections"][name][0] - outfile.tell()))
+                outfile.write(values.tobytes())
+        os.replace(tmp_path, path)
+
+        return path
+
+    def search(self, pattern: str, recombinants: bool = False, limit: int = None):
+        '''
+        Lineages matching a name, or a pattern ending in a wildcard, as compressed name ->
+        uncompressed name, parents before children. Patterns are matched against the 
+        uncompressed names, so aliased descendants are included: BA.2.* is everything 
+        designated below BA.2 (ex. JN.1), JN.1* is JN.1, JN.10, JN.1.1, ... and K* is every
+        lineage under the K aliases. Takes time proportional to the number of matches.
+
+        recombinants: If True, also include the recombinants of the matching lineages (and
+                      of BA.2 for BA.2.*), their descendants and their own recombinants.
+        limit: Stop after this many lineages, ex. to autocomplete names as they are typed.
+        '''
+
+        if self.trie is None:
+            self.trie = self.create_trie()
+        trie = self.trie
+
+        prefix, wildcard, rest = pattern.partition("*")
+        if rest:
+            raise ValueError(f"Wildcards are only supported at the end of a pattern: {pattern}")
+
+        # Lineages that match by name, and trie nodes whose lineages all match (found lazily,
+        # so a limit stops the search early)
+        lineages, nodes = [], []
+        # Lineage whose recombinants match, without matching itself (BA.2 for BA.2.*)
+        above = None
+        if not wildcard:
+            lineage = self.resolve(prefix)
+            lineages = [lineage] if lineage else []
+        elif "." in prefix:
+            name, piece = prefix.rsplit(".", 1)
+            node = trie.find(self.uncompress(name))
+            if node is not None:
+                nodes = (child for child_piece,child in node[1].items() if child_piece.startswith(piece))
+                above = node[0] if piece == "" else None
+        else:
+            # First pieces and aliases starting with the prefix, in name order, skipping 
+            # the ones below another match (ex. BQ is below BA for B*)
+            def first_nodes():
+                for name in itertools.islice(trie.first, bisect.bisect_left(trie.first, prefix), None):
+                    if not name.startswith(prefix): break
+                    if any(a.startswith(prefix) for a in trie.above[name]): continue
+                    node = trie.find(self.uncompress(name))
+                    if node is not None:
+                        yield node
+            nodes = first_nodes()
+
+        def matches():
+            seen = set()
+            queue = deque([above] if above else [])
+            for lineage in itertools.chain(lineages, itertools.chain.from_iterable(trie.walk(node) for node in nodes)):
+                if lineage in seen: continue
+                seen.add(lineage)
+                if recombinants: queue.append(lineage)
+                yield lineage
+            # Recombinants of the matches, their descendants and their recombinants in turn
+            while recombinants and queue:
+                for recombinant in trie.recombinants.get(queue.popleft(), []):
+                    if recombinant in seen: continue
+                    for lineage in trie.walk(trie.find(self.network[recombinant]["uncompressed"])):
+                        if lineage in seen: continue
+                        seen.add(lineage)
+                        queue.append(lineage)
+                        yield lineage
+
+        network = self.network
+        return OrderedDict((lineage, network[lineage]["uncompressed"]) for lineage in itertools.islice(matches(), limit))
+
+    def shortest_path(self, start: str, end: str, network: OrderedDict = None):
+        '''
+        Get the shortest path between two lineages, the first one get_paths would return
+        among those of minimal length. Empty if the lineages are unrelated.
+        '''
 
         if not network:
             network = self.network
+        start, end = self.resolve(start) or start, self.resolve(end) or end
 
-        lines = []
+        if start == end:
+            return [start]
+        neighbours, reaches = self.get_path_steps(start=start, end=end, network=network)
+        if not neighbours:
+            return []
 
-        lines.append("digraph PangoNet {")
-        lines.append("  rankdir=LR;")
-        for lineage,info in network.items():
-            if len(info["parents"]) == 0:
-                lines.append(f"  \"{lineage}\";")
-            else:
-                for parent in info["parents"]:
-                    length = (info["depth"] - network[parent]["depth"])
-                    lines.append(f"  \"{parent}\" -> \"{lineage}\" [len = {length}];")
-        lines.append("}")                    
-        dot  = "\n".join(lines)
-        return dot
+        # Breadth-first search, the first discovery of each lineage comes from the 
+        # earliest path in get_paths order
+        previous = {start: None}
+        queue = deque([start])
+        while queue:
+            lineage = queue.popleft()
+            if lineage == end:
+                break
+            for n in neighbours(lineage):
+                if n not in previous and reaches(n):
+                    previous[n] = lineage
+                    queue.append(n)
+
+        path = []
+        lineage = end
+        while lineage is not None:
+            path.append(lineage)
+            lineage = previous[lineage]
+        return list(reversed(path))
+
+    def stage(self, name: str):
+        '''
+        Record a stage in the profile, if there is one. Does nothing otherwise.
+        '''
+        if self.profile is None:
+            return nullcontext(dict())
+        return self.profile.stage(name)
 
+    def to_arrow(self, closure: bool = True, recombinant_descendants: set = None):
+        '''
+        Nodes, edges and (optionally) closure tables of the network as pyarrow Tables,
+        with the columns of NETWORK_TABLES. Requires pyarrow.
+        '''
+
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("Arrow and parquet exports require pyarrow: pip install pyarrow")
+
+        types = {"TEXT": pa.string(), "INTEGER": pa.int32()}
+        tables = OrderedDict()
+        for table,rows in self.get_tables(closure=closure, recombinant_descendants=recombinant_descendants).items():
+            columns = NETWORK_TABLES[table][0]
+            values = list(zip(*rows)) or [[] for _ in columns]
+            schema = pa.schema([
+                (column, pa.bool_() if column.startswith("recombinant") else types[sql_type.split()[0]])
+                for column,sql_type in columns
+            ])
+            tables[table] = pa.Table.from_arrays([pa.array(v, type=f.type) for v,f in zip(values, schema)], schema=schema)
+        return tables
+
+    def to_dot(self, network: OrderedDict = None, file=None):
+        '''
+        Convert network to dot, written line by line to file if given.
+        '''
 
-    def to_json(self, network: OrderedDict = None, compact=False):
         if not network:
             network = self.network
 
-        # Compact down network objects to simpler lists
-        if compact:
-            network = copy.deepcopy(network)
+        def lines():
+            yield "digraph PangoNet {"
+            yield "  rankdir=LR;"
             for lineage,info in network.items():
-                network[lineage]["parents"]     = ", ".join(info["parents"])
-                network[lineage]["children"]    = ", ".join(info["children"])
-                network[lineage]["ancestors"]   = ", ".join(info["ancestors"])
-                network[lineage]["descendants"] = ", ".join(info["descendants"])
-        
-        json_data = str(json.dumps(network, indent=4))
-        return json_data
+                if len(info["parents"]) == 0:
+                    yield f"  \"{lineage}\";"
+                else:
+                    for parent in info["parents"]:
+                        length = (info["depth"] - network[parent]["depth"])
+                        yield f"  \"{parent}\" -> \"{lineage}\" [len = {length}];"
+            yield "}"
 
+        return self.write_output(lines(), file=file)
 
-    def to_mermaid(self, network: OrderedDict = None):
 
+    def to_json(self, network: OrderedDict = None, compact=False, file=None):
+        '''
+        Convert network to json, written node by node to file if given.
+        '''
         if not network:
             network = self.network
-        lines = []
 
-        lines.append("graph LR;")
-        for lineage,info in network.items():
-            for parent in info["parents"]:
-                # Calculate the depth difference between the parent and lineage
-                # Ex. B (1) --> B.1 (2) is diff=1, which means the arrow will be -->
-                # Ex. BJ.1 (8) --> XBB (11) is diff=3, which means the arrow will be ---->
-                depth_diff = (info["depth"] - network[parent]["depth"]) - 1
-                arrow = "--" + ("-" * depth_diff) + ">"
-                lines.append(f"  {parent}{arrow}{lineage};")
+        # Dump one node at a time (no copy of the whole network), the text is the
+        # same as dumping the entire network at once with indent=4
+        def chunks():
+            sep = "{\n"
+            for lineage,info in network.items():
+                info = dict(info)
+                # Compact down network objects to simpler lists
+                if compact:
+                    for key in ["parents", "children", "ancestors", "descendants"]:
+                        info[key] = ", ".join(info[key])
+                yield sep + json.dumps({lineage: info}, indent=4)[2:-2]
+                sep = ",\n"
+            yield "{}" if sep == "{\n" else "\n}"
 
-        mermaid = "\n".join(lines)
-        return mermaid
+        return self.write_output(chunks(), file=file, sep="")
 
 
-    def to_newick(self, node: str=None, parent: str=None, processed:set=set(), depth:int=0, extended:bool=True):
+    def to_mermaid(self, network: OrderedDict = None, file=None):
         '''
-        Convert network to newick.
+        Convert network to mermaid, written line by line to file if given.
         '''
 
+        if not network:
+            network = self.network
+
+        def lines():
+            yield "graph LR;"
+            for lineage,info in network.items():
+                for parent in info["parents"]:
+                    # Calculate the depth difference between the parent and lineage
+                    # Ex. B (1) --> B.1 (2) is diff=1, which means the arrow will be -->
+                    # Ex. BJ.1 (8) --> XBB (11) is diff=3, which means the arrow will be ---->
+                    depth_diff = (info["depth"] - network[parent]["depth"]) - 1
+                    arrow = "--" + ("-" * depth_diff) + ">"
+                    yield f"  {parent}{arrow}{lineage};"
+
+        return self.write_output(lines(), file=file)
+
+
+    def to_newick(self, node: str=None, extended:bool=True, file=None):
+        '''
+        Convert network to newick, written piece by piece to file if given.
+        '''
+
+        network = self.network
+
         # If no root node given, use first node in the network
-        if depth == 0:
-            processed = dict()
-            if not node:
-                node = list(self.network.keys())[0]
+        if not node:
+            node = next(iter(network))
+        node = self.resolve(node) or node
 
         # Make all branches length of 1
         branch_length = 1
 
-        children = self.network[node]["children"]
-        parents = self.network[node]["parents"]
-
-        # If we are using extended newick syntax, use special '#' syntax for recombinant nodes (ex. XBC#XBC)
-        if extended:
-            if len(parents) > 1:
-                node = f"{node}#{node}"
-        # If we are not using extended newick, we will handle recombinants with multiple parents
-        # by simply assigning the recombinant as a child to the first parent encountered, all other 
-        # parents will be skipped
-        elif len(parents) > 1 and node in processed:
-            return (None, processed)
-
-        # Recursively call function on all children
-        newick_children = []
-        for child in children:
-            # Skip this child if we've already processed the node -> child relationships
-            if node in processed and child in processed[node]: continue
-            newick_child, _processed_child = self.to_newick(node=child, parent=node, processed=processed, depth=depth+1, extended=extended)
-            # Mark the node -> child relationship as processed
-            if node not in processed:
-                processed[node] = set()
-            processed[node].add(child)
-            if newick_child:
-                newick_children.append(newick_child)
-
-        # Add all children newicks as sister clades
-        if len(newick_children) > 0:
-            newick = f"({','.join(newick_children)}){node}:{branch_length}"
-        # Otherwise, make simple single node newick
-        else:
-            newick = f"{node}:{branch_length}"
-
-        # For the final iteration (at root level), set the root branch length to 0, to enable IcyTree tree layouts
-        # If all branch lengths are same (ex. 1), IcyTree will only allow cladogram layout
-        if depth == 0:
-            newick += ";"
-            newick = newick.replace(f":{branch_length};", ":0;")
-
-        # On the last iteration, simply return the newick string
-        if depth == 0:
-            return newick
-        # Otherwise, return both newick and nodes processed so far
-        else:
-            return (newick, processed)
+        # The node -> child relationships already visited, and the nodes they start from
+        processed = set()
+        expanded  = set()
+
+        def label(lineage):
+            parents = network[lineage]["parents"]
+            # If we are using extended newick syntax, use special '#' syntax for recombinant nodes (ex. XBC#XBC)
+            if extended:
+                if len(parents) > 1:
+                    lineage = f"{lineage}#{lineage}"
+            # If we are not using extended newick, we will handle recombinants with multiple parents
+            # by simply assigning the recombinant as a child to the first parent encountered, all other 
+            # parents will be skipped
+            elif len(parents) > 1 and lineage in expanded:
+                return None
+            return lineage
+
+        def pieces():
+            # Walk depth-first with an explicit stack, writing each node's clade as it closes.
+            # The stack is kept as parallel lists: node label, children, next child and
+            # whether the opening '(' of the children was written.
+            labels, children, positions, opened = [label(node)], [network[node]["children"]], [0], [False]
+            while labels:
+                i = positions[-1]
+                if i < len(children[-1]):
+                    positions[-1] = i + 1
+                    parent, child = labels[-1], children[-1][i]
+                    # Skip this child if we've already processed the node -> child relationships
+                    if (parent, child) in processed: continue
+                    # Mark the node -> child relationship as processed
+                    processed.add((parent, child))
+                    expanded.add(parent)
+                    child_label = label(child)
+                    if child_label is None: continue
+                    # Children are written as sister clades
+                    yield "," if opened[-1] else "("
+                    opened[-1] = True
+                    labels.append(child_label)
+                    children.append(network[child]["children"])
+                    positions.append(0)
+                    opened.append(False)
+                    continue
+
+                lineage = labels.pop()
+                children.pop()
+                positions.pop()
+                if opened.pop():
+                    yield ")"
+                # The root branch length is 0, to enable IcyTree tree layouts
+                # If all branch lengths are same (ex. 1), IcyTree will only allow cladogram layout
+                if labels:
+                    yield f"{lineage}:{branch_length}"
+                else:
+                    yield f"{lineage}:0;"
 
+        return self.write_output(pieces(), file=file, sep="")
 
-    def to_table(self, sep="\t"):
+
+    def to_parquet(self, path: str, closure: bool = True, recombinant_descendants: set = None):
         '''
-        Create tsv table.
+        Write the tables of to_arrow to a directory of parquet files, ex. pango.parquet/nodes.parquet,
+        pango.parquet/edges.parquet and pango.parquet/closure.parquet. Requires pyarrow.
+        Returns path.
         '''
 
-        header = sep.join(["lineage", "parents", "children", "recombinant", "recombinant_descendant"])
-        rows   = [header]
-        recombinant_descendants = self.get_recombinants(descendants=True)
-        for lineage,info in self.network.items():
-            row = [
-                lineage,
-                ", ".join(info["parents"]),
-                ", ".join(info["children"]),
-                True if lineage in self.recombinants else False,
-                True if lineage in recombinant_descendants else False
-            ]
-            row = [str(r)for r in row]
-            rows.append(sep.join(row))
+        tables = self.to_arrow(closure=closure, recombinant_descendants=recombinant_descendants)
+        import pyarrow.parquet as pq
 
-        table = "\n".join(rows)
-        return table
+        os.makedirs(path, exist_ok=True)
+        for table,values in tables.items():
+            with atomic_path(os.path.join(path, f"{table}.parquet")) as tmp_path:
+                pq.write_table(values, tmp_path)
+        return path
+
+    def to_sqlite(self, path: str, closure: bool = True, recombinant_descendants: set = None):
+        '''
+        Write the nodes, edges and (optionally) closure tables of NETWORK_TABLES to a SQLite
+        database, indexed on lineage, parent and ancestor. An existing file is replaced once
+        the new one is complete. Returns path.
+
+            SELECT n.* FROM closure c JOIN nodes n ON n.lineage = c.lineage WHERE c.ancestor = 'JN.1'
+        '''
+
+        import sqlite3
+
+        tables = self.get_tables(closure=closure, recombinant_descendants=recombinant_descendants)
+        with atomic_path(path) as tmp_path:
+            connection = sqlite3.connect(tmp_path)
+            try:
+                # The file is only renamed into place once complete, it doesn't need a journal
+                connection.execute("PRAGMA journal_mode = OFF")
+                connection.execute("PRAGMA synchronous = OFF")
+                with connection:
+                    for table,rows in tables.items():
+                        columns, indices = NETWORK_TABLES[table]
+                        connection.execute(f"CREATE TABLE {table} ({', '.join(f'{c} {t}' for c,t in columns)})")
+                        connection.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))})", rows)
+                        for index in indices:
+                            connection.execute(f"CREATE INDEX {table}_{'_'.join(index)} ON {table} ({', '.join(index)})")
+            finally:
+                connection.close()
+        return path
+
+    def to_table(self, sep="\t", file=None, recombinant_descendants: set = None):
+        '''
+        Create tsv table, written row by row to file if given.
+
+        recombinant_descendants: Set of the recombinants and their descendants, if already
+                                 computed (ex. shared between exports, see export_network)
+        '''
+
+        if recombinant_descendants is None:
+            recombinant_descendants = set(self.get_recombinants(descendants=True))
+
+        def rows():
+            yield sep.join(["lineage", "parents", "children", "recombinant", "recombinant_descendant"])
+            for lineage,info in self.network.items():
+                row = [
+                    lineage,
+                    ", ".join(info["parents"]),
+                    ", ".join(info["children"]),
+                    True if lineage in self.recombinants else False,
+                    True if lineage in recombinant_descendants else False
+                ]
+                row = [str(r)for r in row]
+                yield sep.join(row)
+
+        return self.write_output(rows(), file=file)
 
     def uncompress(self, lineage):
         '''
         Uncompress lineage name.
         '''
 
+        uncompressed = self.uncompress_cache.get(lineage)
+        if uncompressed is not None:
+            return uncompressed
+        name = lineage
+
         # Split nomenclature on '.'. ex. BC = B.1.1.529.1.1.1
         # [ 'B', '1', '1', '529', '1', '1', '1']
         lineage_split = lineage.split(".")
@@ -576,26 +2412,733 @@ class PangoNet:
             suffix = lineage_split[1:] if len(lineage_split) > 1 else []
             lineage_split = [self.aliases[prefix]] + suffix
             lineage = ".".join(lineage_split)
+        self.uncompress_cache[name] = lineage
         return(lineage)
 
+    def uncompress_many(self, lineages: [str]):
+        '''
+        Uncompress a batch of lineage names, each distinct name is only uncompressed once.
+        '''
+
+        lineages = list(lineages)
+        uncompressed = {lineage:self.uncompress(lineage) for lineage in dict.fromkeys(lineages)}
+        return [uncompressed[lineage] for lineage in lineages]
+
+    def update(self, alias_key: str, lineage_notes: str):
+        '''
+        Update the network to a new alias key and lineage notes, without rebuilding it.
+        Lineages are added, withdrawn and relinked to new parents in place of the old ones, and
+        only the ancestors, descendants and depth they affect are recomputed. The result is the
+        same network that build would create. Returns the lineages that were added, withdrawn
+        and relinked (their parents changed).
+        '''
+
+        old = self.network
+        old_lineages = ([self.root] if self.root else []) + self.lineages
+        old_aliases, old_recombinants = self.aliases, self.recombinants
+
+        self.sources      = {"alias_key": hash_file(alias_key), "lineage_notes": hash_file(lineage_notes)}
+        self.lineages     = self.parse_lineages(lineage_notes, descriptions=self.descriptions is not None)
+        alias_key_data    = self.parse_alias_key(alias_key)
+        self.aliases      = self.parse_aliases(alias_key_data)
+        self.recombinants = self.parse_recombinants(alias_key_data)
+        # Keep the compress and uncompress caches unless the aliases changed
+        renamed = self.aliases != old_aliases
+        if renamed:
+            self.aliases_reverse = self.create_aliases_reverse()
+
+        # The parents every lineage has now, the root (or first lineage) has none. With the
+        # same aliases, only new lineages and recombinants can have different parents.
+        parents = OrderedDict()
+        for lineage in ([self.root] if self.root else []) + self.lineages:
+            if len(parents) == 0:
+                parents[lineage] = []
+            elif lineage in old and not renamed and lineage not in self.recombinants and lineage not in old_recombinants:
+                parents[lineage] = old[lineage]["parents"]
+            else:
+                parents[lineage] = self.create_parents(lineage)
+
+        report = {
+            "added":     [l for l in parents if l not in old],
+            "withdrawn": [l for l in old_lineages if l not in parents],
+            "relinked":  [l for l in parents if l in old and old[l]["parents"] != parents[l]],
+        }
+        logger.info(f"Updating network: {', '.join(f'{len(v)} {k}' for k,v in report.items())}")
+
+        # A compact network has no closure to maintain, it is quick to recreate
+        if isinstance(old, CompactNetwork):
+            self.network = self.create_network(closure=False)
+            self.names   = self.create_names()
+            self.trie    = None
+            self.graph   = CompactNetwork(self.network)
+            self.index   = NetworkIndex(self.graph)
+            self.network = self.graph
+            return report
+
+        changed  = report["added"] + report["relinked"]
+        withdrawn = report["withdrawn"]
+
+        # Nodes are copied before they are modified, so the old network stays intact
+        network = OrderedDict()
+        for lineage,lineage_parents in parents.items():
+            if lineage in old and not renamed:
+                uncompressed = old[lineage]["uncompressed"]
+            else:
+                uncompressed = self.uncompress(lineage) if lineage != self.root else ""
+            if lineage in old:
+                info = old[lineage]
+                if info["parents"] != lineage_parents or info["uncompressed"] != uncompressed:
+                    info = dict(info, parents=lineage_parents, uncompressed=uncompressed)
+            else:
+                info = {"uncompressed": uncompressed, "depth": 0, "parents": lineage_parents, "children": [], "ancestors": [], "descendants": []}
+            network[lineage] = info
+
+        def modify(lineage, **values):
+            if network[lineage] is old.get(lineage):
+                network[lineage] = dict(network[lineage])
+            network[lineage].update(values)
+
+        # Children: relist the children of the old and new parents of everything that moved
+        moved = set(changed + withdrawn)
+        relist = set(p for l in moved if l in parents for p in parents[l])
+        relist.update(p for l in moved if l in old for p in old[l]["parents"] if p in network)
+        relist.update(report["added"])
+        children = {lineage:[] for lineage in relist}
+        for lineage,lineage_parents in parents.items():
+            for parent in lineage_parents:
+                if parent in children:
+                    children[parent].append(lineage)
+        for lineage,lineage_children in children.items():
+            if network[lineage]["children"] != lineage_children:
+                modify(lineage, children=lineage_children)
+
+        # Ancestors: the changed lineages and everything below them, parents first
+        below = set()
+        queue = deque(changed)
+        while queue:
+            lineage = queue.popleft()
+            if lineage in below: continue
+            below.add(lineage)
+            queue.extend(network[lineage]["children"])
+        order = self.get_topological_order(network=network)
+        for lineage in order:
+            if lineage not in below: continue
+            ancestors = []
+            for parent in network[lineage]["parents"]:
+                ancestors += [parent] + network[parent]["ancestors"]
+            modify(lineage, ancestors=list(dict.fromkeys(ancestors)))
+
+        # Descendants: everything above the changed or withdrawn lineages, children first
+        above = set(report["added"])
+        for lineage in changed:
+            above.update(network[lineage]["ancestors"])
+        for lineage in report["relinked"] + withdrawn:
+            above.update(a for a in old[lineage]["ancestors"] if a in network)
+        for lineage in reversed(order):
+            if lineage not in above: continue
+            descendants = []
+            for child in network[lineage]["children"]:
+                descendants += [child] + network[child]["descendants"]
+            modify(lineage, descendants=list(dict.fromkeys(descendants)))
+
+        # Depth: lineages below the changed ones, whose uncompressed name changed or whose parents' depth changed
+        deepened = set()
+        for lineage in order:
+            info = network[lineage]
+            relabelled = lineage in old and info["uncompressed"] != old[lineage]["uncompressed"]
+            if lineage not in below and not relabelled and deepened.isdisjoint(info["parents"]):
+                continue
+            if lineage == self.root:
+                depth = 0
+            # Recombinants and their descendants are one deeper than their deepest parent
+            elif any(len(network[l]["parents"]) > 1 for l in [lineage] + info["ancestors"]):
+                depth = max([network[p]["depth"] for p in info["parents"]] + [0]) + 1
+            else:
+                depth = len(info["uncompressed"].split("."))
+            if depth != info["depth"]:
+                modify(lineage, depth=depth)
+                deepened.add(lineage)
+
+        self.network = network
+        self.names   = self.create_names()
+        self.trie    = None
+        self.graph   = CompactNetwork(network)
+        self.index   = NetworkIndex(self.graph)
+
+        return report
+
+    def write_output(self, chunks, file=None, sep="\n"):
+        '''
+        Write exporter chunks to a writable text stream as they are produced.
+        If no stream is given, return them joined into one string instead.
+        '''
+
+        if file is None:
+            return sep.join(chunks)
+        for i,chunk in enumerate(chunks):
+            if i > 0:
+                file.write(sep)
+            file.write(chunk)
+
+# Columns appended to each row by PangoNet.annotate and annotate_file
+ANNOTATE_COLUMNS = ["uncompressed", "parents", "depth", "recombinant", "reporting_clade"]
+
+class Annotator:
+    '''
+    Appends the network context of each row's lineage to chunks of TSV/CSV lines.
+    '''
+
+    def __init__(self, pango: PangoNet, column: int, clades: [str] = None, sep: str = "\t"):
+        self.pango = pango
+        self.column = column
+        self.clades = clades
+        self.sep = sep
+        # Formatted columns of every distinct lineage seen so far
+        self.annotations = dict()
+
+    def __call__(self, lines: [str]):
+        sep, column = self.sep, self.column
+
+        lines = [line.rstrip("\r\n") for line in lines]
+        lineages = []
+        for line in lines:
+            # Only lines with quoted fields need the csv parser
+            fields = next(csv.reader([line], delimiter=sep)) if '"' in line else line.split(sep)
+            lineages.append(fields[column] if column < len(fields) else "")
+
+        new = [lineage for lineage in dict.fromkeys(lineages) if lineage not in self.annotations]
+        for lineage,values in zip(new, self.pango.annotate(new, clades=self.clades)):
+            buffer = io.StringIO()
+            csv.writer(buffer, delimiter=sep, lineterminator="").writerow([str(v) for v in values])
+            self.annotations[lineage] = buffer.getvalue()
+
+        annotations = self.annotations
+        return "".join(f"{line}{sep}{annotations[lineage]}\n" for line,lineage in zip(lines, lineages))
+
+# Annotator of a worker process, see annotate_file
+annotator = None
+
+def init_annotator(path: str, column: int, clades: [str], sep: str):
+    '''
+    Load the memory-mapped network in a worker process.
+    '''
+    global annotator
+    annotator = Annotator(PangoNet().load_mmap(path), column, clades=clades, sep=sep)
+
+def run_annotator(lines: [str]):
+    return annotator(lines)
+
+def annotate_file(
+        pango: PangoNet,
+        input: str,
+        output: str,
+        column: str = "lineage",
+        clades: [str] = None,
+        sep: str = None,
+        chunk_size: int = 100000,
+        processes: int = 1,
+    ):
+    '''
+    Append network context columns to a TSV/CSV of lineage assignments (ex. pangolin or Nextclade),
+    reading and writing it in chunks of rows. Files ending in .gz are read/written gzip compressed.
+    With several processes, the chunks are annotated by workers sharing a memory-mapped network.
+    '''
+
+    # Comma-separated for .csv files, tab-separated otherwise
+    if not sep:
+        sep = "," if ".csv" in os.path.basename(input) else "\t"
+
+    infile = gzip.open(input, "rt") if input.endswith(".gz") else open(input)
+    with infile, open_output(output) as outfile:
+        header = infile.readline().rstrip("\r\n")
+        columns = next(csv.reader([header], delimiter=sep), [])
+        if column not in columns:
+            raise ValueError(f"Column {column} was not found in {input}: {', '.join(columns)}")
+        outfile.write(sep.join([header] + ANNOTATE_COLUMNS) + "\n")
+
+        chunks = iter(lambda: list(itertools.islice(infile, chunk_size)), [])
+        column = columns.index(column)
+
+        if processes <= 1:
+            annotate = Annotator(pango, column, clades=clades, sep=sep)
+            for lines in chunks:
+                outfile.write(annotate(lines))
+            return
+
+        import multiprocessing
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "pango.map")
+            pango.save_mmap(path)
+            with multiprocessing.Pool(processes, initializer=init_annotator, initargs=(path, column, clades, sep)) as pool:
+                # Only keep a few chunks in flight to bound memory, and write them back in order
+                pending = deque()
+                for lines in chunks:
+                    pending.append(pool.apply_async(run_annotator, (lines,)))
+                    if len(pending) >= 2 * processes:
+                        outfile.write(pending.popleft().get())
+                while pending:
+                    outfile.write(pending.popleft().get())
+
+# Output formats of the cli: file extension and description
+EXPORT_FORMATS = OrderedDict([
+    ("tsv",          (".tsv",          "table")),
+    ("nwk",          (".nwk",          "standard newick")),
+    ("enwk",         (".enwk",         "extended newick")),
+    ("mermaid",      (".mermaid",      "mermaid")),
+    ("dot",          (".dot",          "dot")),
+    ("json",         (".json",         "json")),
+    ("compact_json", (".compact.json", "compact json")),
+    ("sqlite",       (".sqlite",       "sqlite")),
+    ("parquet",      (".parquet",      "parquet")),
+])
+
+# Binary formats, written as they are even when the other formats are gzipped
+BINARY_FORMATS = ["sqlite", "parquet"]
+
+# Network exported by the worker processes of export_network, inherited from the parent
+exporter = None
+
+def write_export(pango: PangoNet, format: str, path: str, gzipped: bool = False, recombinant_descendants: set = None):
+    '''
+    Write one of EXPORT_FORMATS to path. The file is written under a temporary name and 
+    renamed when complete, so it is never seen half written.
+    '''
+    if format in BINARY_FORMATS:
+        writer = pango.to_sqlite if format == "sqlite" else pango.to_parquet
+        writer(path, recombinant_descendants=recombinant_descendants)
+        return
+    with atomic_output(path, gzipped) as outfile:
+        if format == "tsv":
+            pango.to_table(file=outfile, recombinant_descendants=recombinant_descendants)
+        elif format in ["nwk", "enwk"]:
+            pango.to_newick(extended=format == "enwk", file=outfile)
+        elif format == "mermaid":
+            pango.to_mermaid(file=outfile)
+        elif format == "dot":
+            pango.to_dot(file=outfile)
+        elif format in ["json", "compact_json"]:
+            pango.to_json(compact=format == "compact_json", file=outfile)
+        else:
+            raise ValueError(f"Unknown export format: {format}")
+        outfile.write("\n")
+
+def run_exporter(format: str, path: str, gzipped: bool, memory: bool):
+    '''
+    Write one export in a worker process, returning its profile stages.
+    '''
+    pango, recombinant_descendants = exporter
+    pango.profile = Profile(memory=memory)
+    with pango.stage(format) as stage:
+        write_export(pango, format, path, gzipped, recombinant_descendants)
+        stage["network"] = pango.network
+    return pango.profile.stages
+
+def export_network(pango: PangoNet, output_prefix: str, formats: [str], gzipped: bool = False, processes: int = None):
+    '''
+    Write the network in several of EXPORT_FORMATS, to output_prefix + extension. 
+
+    The formats are rendered at the same time by a pool of processes (one per format, up to
+    the number of CPUs), which share the network read-only by forking from this process.
+    The recombinant descendants are found once for all of them. Without fork (ex. Windows)
+    or with one process, the formats are written one after another.
+    '''
+
+    global exporter
+
+    paths = OrderedDict()
+    for format in formats:
+        ext = ".gz" if gzipped and format not in BINARY_FORMATS else ""
+        paths[format] = output_prefix + EXPORT_FORMATS[format][0] + ext
+        logger.info(f"Exporting {EXPORT_FORMATS[format][1]}: {paths[format]}")
+    tables = any(format in ["tsv"] + BINARY_FORMATS for format in formats)
+    recombinant_descendants = set(pango.get_recombinants(descendants=True)) if tables else None
+
+    import multiprocessing
+
+    processes = min(len(paths), processes or os.cpu_count() or 1)
+    if processes <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+        for format,path in paths.items():
+            with pango.stage(format) as stage:
+                write_export(pango, format, path, gzipped, recombinant_descendants)
+                stage["network"] = pango.network
+        return list(paths.values())
+
+    # Forked workers see the network as it is now, without pickling it
+    exporter = (pango, recombinant_descendants)
+    memory = pango.profile.memory if pango.profile else False
+    try:
+        with pango.stage("export"), multiprocessing.get_context("fork").Pool(processes) as pool:
+            results = [pool.apply_async(run_exporter, (format, path, gzipped, memory)) for format,path in paths.items()]
+            stages = [stage for result in results for stage in result.get()]
+    finally:
+        exporter = None
+    # The formats overlap in time, the export stage holds the time they took together
+    if pango.profile:
+        pango.profile.stages.extend(dict(stage, parallel=True) for stage in stages)
+
+    return list(paths.values())
+
+class QueryService:
+    '''
+    Answers lineage queries from a network that stays in memory, see serve.
+
+    Results are cached until the network changes. When the input files change (or, if they
+    were downloaded, when github has newer ones), a new network is built in the background
+    and swapped in, while queries keep being answered from the old one.
+    '''
+
+    # Query name -> parameters, and how to answer it with a network and resolved lineages
+    queries = {
+        "parents":     (["lineage"], lambda pango, lineage: pango.get_parents(lineage)),
+        "children":    (["lineage"], lambda pango, lineage: pango.get_children(lineage)),
+        "ancestors":   (["lineage"], lambda pango, lineage: pango.get_ancestors(lineage)),
+        "descendants": (["lineage"], lambda pango, lineage: pango.get_descendants(lineage)),
+        "mrca":        (["lineages"], lambda pango, lineages: pango.get_mrca(lineages)),
+        "paths":       (["start", "end"], lambda pango, start, end: pango.get_paths(start=start, end=end)),
+        "search":      (["pattern"], None),
+        "compress":    (["lineage"], None),
+        "uncompress":  (["lineage"], None),
+    }
+
+    def __init__(
+            self,
+            alias_key: str = None,
+            lineage_notes: str = None,
+            outdir: str = ".",
+            snapshot: str = None,
+            compact: bool = False,
+            cache_size: int = CACHE_SIZE,
+        ):
+        self.alias_key = alias_key or os.path.join(outdir, os.path.basename(ALIAS_KEY_URL))
+        self.lineage_notes = lineage_notes or os.path.join(outdir, os.path.basename(LINEAGE_NOTES_URL))
+        # Inputs that were downloaded are checked against github for newer versions
+        self.downloads = [(url, path) for url,path,given in [
+            (ALIAS_KEY_URL, self.alias_key, alias_key), (LINEAGE_NOTES_URL, self.lineage_notes, lineage_notes)
+        ] if not given]
+        self.outdir = outdir
+        self.snapshot = snapshot
+        self.compact = compact
+        self.cache = LRUCache(cache_size)
+        self.lock = threading.Lock()
+        self.pango = PangoNet().build(
+            alias_key=alias_key, lineage_notes=lineage_notes, outdir=outdir, snapshot=snapshot, compact=compact
+        )
+        self.stats = self.get_stats()
+
+    def batch(self, queries: [dict]):
+        '''
+        Answer many queries at once, each as {"result": ...} or {"error": ...}.
+        '''
+        answers = []
+        for params in queries:
+            if not isinstance(params, dict):
+                answers.append({"error": f"Query is not a JSON object: {json.dumps(params)}"})
+                continue
+            try:
+                answers.append({"result": self.query(params.get("query"), params)})
+            except (KeyError, ValueError, TypeError) as e:
+                answers.append({"error": self.get_error(e)})
+        return answers
+
+    def get_error(self, e: Exception):
+        '''
+        Message of a failed query. str() quotes KeyError messages, so use the message itself.
+        '''
+        if isinstance(e, KeyError) and len(e.args) > 0:
+            return str(e.args[0])
+        return str(e)
+
+    def get_stats(self):
+        '''
+        File size and modification time of the inputs, to notice when they change.
+        '''
+        stats = []
+        for path in [self.alias_key, self.lineage_notes]:
+            stat = os.stat(path)
+            stats.append((stat.st_size, stat.st_mtime_ns))
+        return stats
+
+    def query(self, query: str, params: dict):
+        '''
+        Answer one query, ex. query("mrca", {"lineages": ["XE", "XG"]}). Results are copies,
+        so callers can modify them without changing the cache or the network.
+        Raises KeyError for unknown queries, missing parameters and lineages.
+        '''
+        if query not in self.queries:
+            raise KeyError(f"Unknown query: {query}, expected one of: {', '.join(self.queries)}")
+        names, function = self.queries[query]
+        missing = [name for name in names if name not in params]
+        if missing:
+            raise KeyError(f"Query {query} is missing: {', '.join(missing)}")
+        values = [params[name] for name in names]
+        if query == "mrca" and isinstance(values[0], str):
+            values[0] = values[0].split(",")
+        # Optional search parameters, ex. /search?pattern=BA.2.*&recombinants=true&limit=10
+        if query == "search":
+            values += [str(params.get("recombinants", "")).lower() in ["true", "1"], int(params.get("limit") or 0) or None]
+        key = (query, json.dumps(values))
+
+        # compress and uncompress share the network's caches, so all queries take turns
+        with self.lock:
+            result = self.cache.get(key)
+            if result is not None:
+                return copy.deepcopy(result)
+            pango = self.pango
+            if query == "compress":
+                result = pango.compress(values[0])
+            elif query == "uncompress":
+                result = pango.uncompress(values[0])
+            elif query == "search":
+                result = pango.search(*values)
+            else:
+                values = [[self.resolve(l) for l in v] if isinstance(v, list) else self.resolve(v) for v in values]
+                result = function(pango, *values)
+            self.cache[key] = result
+        return copy.deepcopy(result)
+
+    def refresh(self):
+        '''
+        Swap in a new network if the inputs changed. Returns True if the network changed.
+        '''
+        for url,path in self.downloads:
+            self.pango.download_file(url, path)
+        stats = self.get_stats()
+        if stats == self.stats:
+            return False
+        self.stats = stats
+        sources = {"alias_key": hash_file(self.alias_key), "lineage_notes": hash_file(self.lineage_notes)}
+        if sources == self.pango.sources:
+            return False
+
+        logger.info(f"Inputs changed, rebuilding network: {self.alias_key}, {self.lineage_notes}")
+        pango = PangoNet().build(
+            alias_key=self.alias_key, lineage_notes=self.lineage_notes, outdir=self.outdir, snapshot=self.snapshot, compact=self.compact
+        )
+        with self.lock:
+            self.pango = pango
+            self.cache.clear()
+        logger.info(f"Swapped in new network: {len(pango.lineages)} lineages")
+        return True
+
+    def resolve(self, lineage: str):
+        '''
+        Lineage in the current network, raising a KeyError if it isn't there.
+        '''
+        resolved = self.pango.resolve(lineage)
+        if resolved is None:
+            raise KeyError(f"Unknown lineage: {lineage}")
+        return resolved
+
+    def watch(self, interval: float, stop: threading.Event):
+        '''
+        Check the inputs every interval seconds until stop is set.
+        '''
+        while not stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.warning(f"Keeping the current network, failed to refresh it: {e}")
+
+class QueryHandler(BaseHTTPRequestHandler):
+    '''
+    HTTP interface of a QueryService (self.server.service).
+
+        GET  /<query>?lineage=BA.2, /mrca?lineages=XE,XG, /paths?start=XE&end=B.1.1.529 or /search?pattern=JN.1*
+        POST /  with a JSON query {"query": "parents", "lineage": "BA.2"}, or a list of them
+        GET  /status
+    '''
+
+    # Keep connections open between requests, and send each response in one write
+    # (flushed after every request) so it isn't held back by delayed acknowledgements
+    protocol_version = "HTTP/1.1"
+    wbufsize = io.DEFAULT_BUFFER_SIZE
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = url.path.strip("/")
+        service = self.server.service
+        if query == "status":
+            pango = service.pango
+            self.send_json(200, {"lineages": len(pango.lineages), "sources": pango.sources, "cache": len(service.cache)})
+            return
+        params = dict(urllib.parse.parse_qsl(url.query))
+        try:
+            self.send_json(200, {"result": service.query(query, params)})
+        except KeyError as e:
+            self.send_json(404, {"error": service.get_error(e)})
+        except (ValueError, TypeError) as e:
+            self.send_json(400, {"error": service.get_error(e)})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            queries = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            self.send_json(400, {"error": f"Invalid JSON: {e}"})
+            return
+        # A single query is answered like a batch of one, without the list around it
+        answers = self.server.service.batch(queries if isinstance(queries, list) else [queries])
+        self.send_json(200, answers if isinstance(queries, list) else answers[0])
+
+    def address_string(self):
+        # Unix socket clients don't have an address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+    def send_json(self, status: int, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# Unix sockets are not available on every platform (ex. Windows)
+if hasattr(socketserver, "UnixStreamServer"):
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        '''
+        HTTP server on a Unix socket, for clients on the same host.
+        '''
+        daemon_threads = True
+
+def serve(service: QueryService, host: str = "127.0.0.1", port: int = 8080, socket: str = None, interval: float = 60):
+    '''
+    Answer queries over HTTP on host:port, or a Unix socket if given, until interrupted.
+    The inputs are checked for changes every interval seconds (never if 0).
+    '''
+
+    if socket:
+        if not hasattr(socketserver, "UnixStreamServer"):
+            raise ValueError("Unix sockets are not supported on this platform, serve on a host and port instead")
+        if os.path.exists(socket):
+            os.remove(socket)
+        server = UnixHTTPServer(socket, QueryHandler)
+        logger.info(f"Serving on {socket}")
+    else:
+        server = ThreadingHTTPServer((host, port), QueryHandler)
+        logger.info(f"Serving on http://{host}:{server.server_address[1]}")
+    server.service = service
+
+    stop = threading.Event()
+    if interval:
+        threading.Thread(target=service.watch, args=(interval, stop), daemon=True).start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        if socket and os.path.exists(socket):
+            os.remove(socket)
+
+def hash_file(path: str):
+    '''
+    sha256 hex digest of a file's content.
+    '''
+    digest = hashlib.sha256()
+    with open(path, "rb") as infile:
+        for chunk in iter(lambda: infile.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def open_output(path: str, gzipped: bool = False):
+    '''
+    Open a text file for writing, gzip compressed if requested or the path ends in .gz.
+    '''
+    if gzipped or path.endswith(".gz"):
+        return gzip.open(path, "wt")
+    return open(path, "w")
+
+@contextmanager
+def atomic_output(path: str, gzipped: bool = False):
+    '''
+    Like open_output, but written to a temporary file that replaces path once it is 
+    closed. If writing fails, path is left as it was.
+    '''
+    with atomic_path(path) as tmp_path, open_output(tmp_path, gzipped or path.endswith(".gz")) as outfile:
+        yield outfile
+
+@contextmanager
+def atomic_path(path: str):
+    '''
+    Temporary path to write to instead of path, which it replaces at the end of the block.
+    If writing fails, path is left as it was.
+    '''
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def write_profile(profile: Profile, path: str):
+    '''
+    Write the stages recorded in a profile to a JSON file, if profiling.
+    '''
+    if profile is None:
+        return
+    logger.info(f"Writing profile: {path}")
+    with open(path, "w") as outfile:
+        profile.to_json(file=outfile)
+        outfile.write("\n")
+
 def get_cli_options():
     import argparse
 
     description = 'pangonet v0.1.0 | Create and manipulate SARS-CoV-2 pango lineages in a phylogenetic network.'
-    parser = argparse.ArgumentParser(description=description)
+    # Abbreviations are off, so subcommand options such as --output don't clash with --output-prefix
+    parser = argparse.ArgumentParser(description=description, allow_abbrev=False)
 
     parser.add_argument('--lineage-notes', help='Path to the lineage_notes.txt')
     parser.add_argument('--alias-key',     help='Path to the alias_key.json')
     parser.add_argument('--output-prefix', help='Output prefix', default="pango")
-    parser.add_argument('--output-all',    help='Output all formats', action="store_true")
+    parser.add_argument('--snapshot',      help='Path to a binary snapshot of the network, reused if it matches the input files')
+    parser.add_argument('--output-all',    help='Output all formats, except the --sqlite and --parquet tables', action="store_true")
     parser.add_argument('--tsv',           help='Output metadata TSV', action="store_true")
     parser.add_argument('--json',          help='Output json', action="store_true")    
     parser.add_argument('--nwk',           help='Output newick tree', action="store_true")
     parser.add_argument('--enwk',          help='Output extended newick tree for IcyTree', action="store_true")
     parser.add_argument('--mermaid',       help='Output mermaid graph', action="store_true")
     parser.add_argument('--dot',           help='Output dot for graphviz', action="store_true")
+    parser.add_argument('--sqlite',        help='Output node, edge and closure tables as an indexed SQLite database', action="store_true")
+    parser.add_argument('--parquet',       help='Output node, edge and closure tables as parquet files (requires pyarrow)', action="store_true")
+    parser.add_argument('--gzip',          help='Gzip compress the output files', action="store_true")
+    parser.add_argument('--processes',     help='Number of processes to export with (default: one per format, up to the number of CPUs)', type=int)
+    parser.add_argument('--profile',       help='Path to a JSON file with the time, network size and peak memory of each build and export stage')
     parser.add_argument('-v', '--version',       help='Print version', action="store_true")
 
+    subparsers = parser.add_subparsers(dest="command", title="subcommands")
+
+    # The network options can also be given after the subcommand, without resetting those given before it
+    annotate = subparsers.add_parser("annotate", help="Annotate a TSV/CSV of lineage assignments with network context")
+    annotate.add_argument('--input',         help='Path to the TSV/CSV of lineage assignments (ex. pangolin or Nextclade output)', required=True)
+    annotate.add_argument('--output',        help='Path to the annotated TSV/CSV, gzip compressed if it ends in .gz', required=True)
+    annotate.add_argument('--column',        help='Column with the lineage of each row', default="lineage")
+    annotate.add_argument('--clades',        help='Comma-separated reporting clades, ex. JN.1,KP.2,XBB')
+    annotate.add_argument('--sep',           help='Column separator (default: comma for .csv files, otherwise tab)')
+    annotate.add_argument('--chunk-size',    help='Rows read and annotated at a time', type=int, default=100000)
+    annotate.add_argument('--processes',     help='Number of processes to annotate with', type=int, default=1)
+    annotate.add_argument('--lineage-notes', help='Path to the lineage_notes.txt', default=argparse.SUPPRESS)
+    annotate.add_argument('--alias-key',     help='Path to the alias_key.json', default=argparse.SUPPRESS)
+    annotate.add_argument('--snapshot',      help='Path to a binary snapshot of the network, reused if it matches the input files', default=argparse.SUPPRESS)
+
+    serve = subparsers.add_parser("serve", help="Answer lineage queries over HTTP or a Unix socket, keeping the network in memory")
+    serve.add_argument('--host',          help='Host to listen on', default="127.0.0.1")
+    serve.add_argument('--port',          help='Port to listen on', type=int, default=8080)
+    serve.add_argument('--socket',        help='Path to a Unix socket to listen on, instead of host and port')
+    serve.add_argument('--interval',      help='Seconds between checks for updated input files, 0 to never check', type=float, default=60)
+    serve.add_argument('--cache-size',    help='Number of query results to cache', type=int, default=CACHE_SIZE)
+    serve.add_argument('--compact',       help='Keep a compact network in memory (less memory, slower ancestors and descendants)', action="store_true")
+    serve.add_argument('--lineage-notes', help='Path to the lineage_notes.txt', default=argparse.SUPPRESS)
+    serve.add_argument('--alias-key',     help='Path to the alias_key.json', default=argparse.SUPPRESS)
+    serve.add_argument('--snapshot',      help='Path to a binary snapshot of the network, reused if it matches the input files', default=argparse.SUPPRESS)
+
     return parser.parse_args()
 
 def cli():
@@ -606,76 +3149,56 @@ def cli():
         print("pangonet v0.1.0")
         sys.exit(0)
 
-    logging.info(f"Begin") 
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, format='%(asctime)s %(levelname)s:%(message)s')
+    profile = Profile() if options.profile else None
+
+    logger.info(f"Begin") 
+
+    if options.command == "annotate":
+        outdir = os.path.dirname(options.output)
+        pango = PangoNet(profile=profile).build(alias_key=options.alias_key, lineage_notes=options.lineage_notes, outdir=outdir or ".", snapshot=options.snapshot)
+        clades = options.clades.split(",") if options.clades else None
+        logger.info(f"Annotating {options.input}: {options.output}")
+        with pango.stage("annotate"):
+            annotate_file(
+                pango, options.input, options.output, column=options.column, clades=clades, sep=options.sep,
+                chunk_size=options.chunk_size, processes=options.processes
+            )
+        write_profile(profile, options.profile)
+        logger.info(f"Done")
+        return
+
+    if options.command == "serve":
+        service = QueryService(
+            alias_key=options.alias_key, lineage_notes=options.lineage_notes, outdir=os.path.dirname(options.output_prefix) or ".",
+            snapshot=options.snapshot, compact=options.compact, cache_size=options.cache_size,
+        )
+        serve(service, host=options.host, port=options.port, socket=options.socket, interval=options.interval)
+        logger.info(f"Done")
+        return
 
     # Check output directory based on prefix
     outdir = os.path.dirname(options.output_prefix)
     if outdir != "" and outdir != "." and not os.path.exists(outdir):
-        logging.info(f"Creating output directory: {outdir}")        
+        logger.info(f"Creating output directory: {outdir}")        
         os.makedirs(outdir)
 
     # Create the network from the alias key and lineage notes, will download the files if not given
-    pango = PangoNet().build(alias_key=options.alias_key, lineage_notes=options.lineage_notes, outdir=outdir)
+    pango = PangoNet(profile=profile).build(alias_key=options.alias_key, lineage_notes=options.lineage_notes, outdir=outdir, snapshot=options.snapshot)
 
     # -------------------------------------------------------------------------
     # Export
     # -------------------------------------------------------------------------
 
-    # Table (for IcyTree)
-    if options.output_all or options.tsv:
-        table_path = options.output_prefix + ".tsv"
-        logging.info(f"Exporting table: {table_path}")
-        table = pango.to_table()
-        with open(table_path, 'w') as outfile:
-            outfile.write(table + "\n")
-
-    # Standard newick
-    if options.output_all or options.nwk:
-        newick_path = options.output_prefix + ".nwk"
-        logging.info(f"Exporting standard newick: {newick_path}")
-        newick = pango.to_newick(extended=False)
-        with open(newick_path, 'w') as outfile:
-            outfile.write(newick + "\n")
-
-    # Extended newick
-    if options.output_all or options.enwk:
-        newick_path = options.output_prefix + ".enwk"
-        logging.info(f"Exporting extended newick: {newick_path}")
-        newick = pango.to_newick(extended=True)
-        with open(newick_path, 'w') as outfile:
-            outfile.write(newick + "\n")
-
-    # Mermaid
-    if options.output_all or options.mermaid:
-        mermaid_path = options.output_prefix + ".mermaid"
-        logging.info(f"Exporting mermaid: {mermaid_path}")        
-        mermaid = pango.to_mermaid()
-        with open(mermaid_path, 'w') as outfile:
-            outfile.write(mermaid + "\n")
-
-    # Dot
-    if options.output_all or options.dot:    
-        dot_path = options.output_prefix + ".dot"
-        dot = pango.to_dot()
-        logging.info(f"Exporting dot: {dot_path}")
-        with open(dot_path, 'w') as outfile:
-            outfile.write(dot + "\n")
-
-    # JSON
-    if options.output_all or options.json:    
-        json_path = options.output_prefix + ".json"
-        logging.info(f"Exporting json: {json_path}")
-        json_data = pango.to_json()
-        with open(json_path, 'w') as outfile:
-            outfile.write(json_data + "\n")
-
-        json_path = options.output_prefix + ".compact.json"    
-        logging.info(f"Exporting compact json: {json_path}") 
-        json_data = pango.to_json(compact=True)
-        with open(json_path, 'w') as outfile:
-            outfile.write(json_data + "\n")
-
-    logging.info(f"Done") 
+    # Each format streams straight into its (optionally gzipped) output file, and
+    # several formats are written at the same time. The sqlite and parquet tables are
+    # only written when asked for, --output-all keeps to the original formats.
+    formats = [f for f in EXPORT_FORMATS if (options.output_all and f not in BINARY_FORMATS) or getattr(options, "json" if f == "compact_json" else f)]
+    if formats:
+        export_network(pango, options.output_prefix, formats, gzipped=options.gzip, processes=options.processes)
+
+    write_profile(profile, options.profile)
+    logger.info(f"Done") 
 
 if __name__ == "__main__":
     cli()
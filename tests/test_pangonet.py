@@ -1,5 +1,6 @@
-from pangonet import PangoNet
+from pangonet import PangoNet, Profile, QueryHandler, QueryService, annotate_file, atomic_output, export_network
 import os
+import pytest
 
 # Version controlled data files for testing expected values
 data_dir      = os.path.join(os.getcwd(), "tests", "data")
@@ -11,12 +12,117 @@ new_dir            = os.path.join(os.getcwd(), "tests", "output")
 new_alias_key     = os.path.join(new_dir, "alias_key.json")
 new_lineage_notes = os.path.join(new_dir, "lineage_notes.txt")
 
+@pytest.fixture
+def server():
+    '''
+    Local stand-in for github: serves server.files by path with ETags, answers the
+    first server.failures requests with a 503, and records the requests' headers.
+    '''
+    import hashlib, threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            httpd.requests.append((self.path, dict(self.headers)))
+            if httpd.failures > 0:
+                httpd.failures -= 1
+                self.send_error(503)
+                return
+            if self.path not in httpd.files:
+                self.send_error(404)
+                return
+            content = httpd.files[self.path]
+            etag = '"' + hashlib.md5(content).hexdigest() + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    httpd.files, httpd.failures, httpd.requests = {}, 0, []
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
 def test_pangonet_init():
     pango = PangoNet()
 
+def test_pangonet_annotate():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    annotations = pango.annotate(["KP.2", "XBB.1.5", "B.1.1.529.1", "Unassigned"], clades=["JN.1", "KP.2", "XBB"])
+    assert annotations[0] == ["B.1.1.529.2.86.1.1.11.1.2", "JN.1.11.1", pango.network["KP.2"]["depth"], False, "KP.2"]
+    assert annotations[1][1:] == ["XBB.1", pango.network["XBB.1.5"]["depth"], False, "XBB"]
+    assert annotations[2][4] == ""
+    assert annotations[3] == ["", "", "", "", ""]
+    assert pango.annotate(["XBB"])[0][3] == True
+
+def test_pangonet_annotate_file(tmp_path):
+    import gzip
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    input_path = os.path.join(tmp_path, "lineages.csv")
+    with open(input_path, "w") as outfile:
+        outfile.write("taxon,lineage,note\n")
+        outfile.write('sample1,"JN.1.1","quoted, note"\n')
+        for i in range(2, 12):
+            outfile.write(f"sample{i},XBB.1.5,\n")
+    expected = [
+        "taxon,lineage,note,uncompressed,parents,depth,recombinant,reporting_clade",
+        f'sample1,"JN.1.1","quoted, note",B.1.1.529.2.86.1.1.1,JN.1,{pango.network["JN.1.1"]["depth"]},False,JN.1',
+    ] + [f"sample{i},XBB.1.5,,XBB.1.5,XBB.1,{pango.network['XBB.1.5']['depth']},False," for i in range(2, 12)]
+
+    output_path = os.path.join(tmp_path, "annotated.csv")
+    annotate_file(pango, input_path, output_path, clades=["JN.1"], chunk_size=4)
+    with open(output_path) as infile:
+        assert infile.read().splitlines() == expected
+
+    # Annotate in worker processes, written gzip compressed
+    output_path = os.path.join(tmp_path, "annotated.csv.gz")
+    annotate_file(pango, input_path, output_path, clades=["JN.1"], chunk_size=4, processes=2)
+    with gzip.open(output_path, "rt") as infile:
+        assert infile.read().splitlines() == expected
+
+    with pytest.raises(ValueError):
+        annotate_file(pango, input_path, output_path, column="Nextclade_pango")
+
 def test_pangonet_build():
     pango = PangoNet().build(outdir=new_dir)
 
+def test_pangonet_build_compact():
+    pango   = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    compact = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes, compact=True)
+    assert list(compact.network) == list(pango.network)
+    for lineage in ["root", "BA.1", "B.1.1.529", "XBB", "XBL", "JN.1.1"]:
+        assert dict(compact.network[lineage]) == pango.network[lineage]
+    assert compact.get_parents("B.1.1.529.1") == ["B.1.1.529"]
+    assert compact.get_children("JN.1.1") == pango.get_children("JN.1.1")
+    assert compact.get_mrca(["XE", "XG"]) == ["BA.1", "BA.2"]
+    assert compact.get_paths(start="XBL", end="B.1.1") == pango.get_paths(start="XBL", end="B.1.1")
+    assert compact.to_newick() == pango.to_newick()
+
+def test_pangonet_cli(tmp_path, monkeypatch):
+    import sys
+    pangonet = sys.modules[PangoNet.__module__]
+    prefix = os.path.join(tmp_path, "pango")
+    argv = ["pangonet", "--alias-key", alias_key, "--lineage-notes", lineage_notes, "--output-prefix", prefix, "--processes", "1"]
+    # The tables are only written when asked for, not by --output-all
+    monkeypatch.setattr(sys, "argv", argv + ["--output-all"])
+    pangonet.cli()
+    assert sorted(os.listdir(tmp_path)) == ["pango.compact.json", "pango.dot", "pango.enwk", "pango.json", "pango.mermaid", "pango.nwk", "pango.tsv"]
+    monkeypatch.setattr(sys, "argv", argv + ["--sqlite"])
+    pangonet.cli()
+    assert os.path.exists(f"{prefix}.sqlite")
+
 def test_pangonet_compress():
     pango = PangoNet().build(alias_key=new_alias_key, lineage_notes=new_lineage_notes)
     assert pango.compress("BA.1")                == "BA.1"
@@ -24,12 +130,159 @@ def test_pangonet_compress():
     assert pango.compress("XBB.1.2")             == "XBB.1.2"
     assert pango.compress("XBC")                 == "XBC"
 
+def test_pangonet_compress_many():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    lineages = ["BA.1", "B.1.1.529.1.1.1.4.5", "XBB.1.2", "BA.1"]
+    assert pango.compress_many(lineages) == ["BA.1", "BC.4.5", "XBB.1.2", "BA.1"]
+    # Cached results must be identical on the second call
+    assert pango.compress_many(lineages) == ["BA.1", "BC.4.5", "XBB.1.2", "BA.1"]
+
+def test_pangonet_count_paths():
+    pango = PangoNet().build(alias_key=new_alias_key, lineage_notes=new_lineage_notes)
+    assert pango.count_paths(start="BA.1", end="BA.1")      == 1
+    assert pango.count_paths(start="XBL",  end="B.1.1")     == 3
+    assert pango.count_paths(start="B.1.1.529", end="XDB")  == 4
+    assert pango.count_paths(start="BA.1", end="BA.2")      == 0
+
+def test_pangonet_create_closure():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    # The single-pass closure should match the recursive lookups exactly, including order
+    for lineage in pango.lineages:
+        assert pango.network[lineage]["ancestors"]   == pango.get_ancestors(lineage)
+        assert pango.network[lineage]["descendants"] == pango.get_descendants(lineage)
+
+def test_pangonet_create_names():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    names = pango.create_names()
+    assert names["JN.1"] == names["B.1.1.529.2.86.1.1"] == "JN.1"
+    assert names["XBB.1.9.2.1"] == names["EG.1"] == "EG.1"
+    assert names["B.1.1.529"] == "B.1.1.529"
+    # Aliases are not names of the lineage they stand for
+    assert "JN" not in names
+    assert set(names.values()) == set(pango.network)
+    assert "B.1.1.529.2.86.1.1" not in pango.network
+
+def test_pangonet_create_network():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    network = pango.network
+    # Aliased recombinant descendants (ex. HZ.2 = XBB.1.5.68.2) are deeper than their parents
+    assert network["HZ.2"]["depth"] > network["XBB.1.5.68"]["depth"]
+    for lineage,info in network.items():
+        assert all(info["depth"] > network[parent]["depth"] for parent in info["parents"])
+
+def test_pangonet_distance_matrix():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    depth = {l:pango.network[l]["depth"] for l in ["BA.1", "BA.2", "B.1.1.529", "XE", "BA.1.1"]}
+    matrix = pango.distance_matrix(["BA.1", "BA.2", "XE", "BA.1.1", "B.1.1.529.1"])
+    assert matrix[0] == [0, 2, 1, 1, 0]
+    assert matrix[1] == [2, 0, 1, 3, 2]
+    # XE descends from both BA.1 and BA.2
+    assert matrix[2][:2] == [depth["XE"] - depth["BA.1"], depth["XE"] - depth["BA.2"]]
+    assert matrix[2][3] == depth["XE"] + depth["BA.1.1"] - 2 * depth["BA.1"]
+    condensed = pango.distance_matrix(["BA.1", "BA.2", "XE", "BA.1.1", "B.1.1.529.1"], condensed=True)
+    assert condensed == [d for i,row in enumerate(matrix) for d in row[i+1:]]
+    # Without a common ancestor the distance is infinite
+    pango_filter = pango.filter(["BA.1", "BA.2"])
+    assert pango_filter.distance_matrix(["BA.1", "BA.2"]) == [[0, float("inf")], [float("inf"), 0]]
+
+def test_pangonet_download_file(server, tmp_path):
+    pango = PangoNet()
+    output = os.path.join(tmp_path, "alias_key.json")
+    server.files["/alias_key.json"] = b'{"BA": "B.1.1.529"}'
+    assert pango.download_file(f"{server.url}/alias_key.json", output) == output
+    with open(output) as infile:
+        assert infile.read() == '{"BA": "B.1.1.529"}'
+    # Unchanged files are not downloaded again
+    pango.download_file(f"{server.url}/alias_key.json", output)
+    assert "If-None-Match" in server.requests[-1][1]
+    # Changed files are, after retrying failed requests
+    server.files["/alias_key.json"] = b'{"BA": "B.1.1.529", "BQ": "B.1.1.529.5.3.1.1.1.1"}'
+    server.failures = 2
+    pango.download_file(f"{server.url}/alias_key.json", output, backoff=0)
+    with open(output) as infile:
+        assert infile.read() == '{"BA": "B.1.1.529", "BQ": "B.1.1.529.5.3.1.1.1.1"}'
+    assert len(server.requests) == 5
+    # Give up after the retries, leaving the previous download in place
+    server.failures = 3
+    with pytest.raises(Exception):
+        pango.download_file(f"{server.url}/alias_key.json", output, retries=2, backoff=0)
+    with pytest.raises(Exception):
+        pango.download_file(f"{server.url}/missing.json", output)
+    with open(output) as infile:
+        assert infile.read() == '{"BA": "B.1.1.529", "BQ": "B.1.1.529.5.3.1.1.1.1"}'
+    assert sorted(os.listdir(tmp_path)) == ["alias_key.json", "alias_key.json.etag"]
+
+def test_pangonet_download_file_build(server, tmp_path, monkeypatch):
+    import sys
+    # The module that defines PangoNet, whether imported as a package or a single script
+    pangonet = sys.modules[PangoNet.__module__]
+    for path in [alias_key, lineage_notes]:
+        with open(path, "rb") as infile:
+            server.files["/" + os.path.basename(path)] = infile.read()
+    monkeypatch.setattr(pangonet, "ALIAS_KEY_URL", f"{server.url}/{os.path.basename(alias_key)}")
+    monkeypatch.setattr(pangonet, "LINEAGE_NOTES_URL", f"{server.url}/{os.path.basename(lineage_notes)}")
+    pango = PangoNet().build(outdir=tmp_path)
+    assert pango.network == PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes).network
+    assert len(server.requests) == 2
+
+def test_pangonet_export_network(tmp_path):
+    import gzip
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    formats = ["tsv", "nwk", "enwk", "mermaid", "dot", "json", "compact_json"]
+    serial = export_network(pango, os.path.join(tmp_path, "serial"), formats, processes=1)
+    parallel = export_network(pango, os.path.join(tmp_path, "parallel"), formats, gzipped=True, processes=3)
+    assert [os.path.basename(p) for p in parallel] == [os.path.basename(p).replace("serial", "parallel") + ".gz" for p in serial]
+    for serial_path,parallel_path in zip(serial, parallel):
+        with open(serial_path) as serial_file, gzip.open(parallel_path, "rt") as parallel_file:
+            assert serial_file.read() == parallel_file.read()
+    with open(serial[0]) as infile:
+        assert infile.read() == pango.to_table() + "\n"
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(p) for p in serial + parallel)
+    # An export that fails leaves the previous file in place
+    with pytest.raises(RuntimeError):
+        with atomic_output(serial[0]) as outfile:
+            outfile.write("partial")
+            raise RuntimeError("Export failed")
+    with open(serial[0]) as infile:
+        assert infile.read() == pango.to_table() + "\n"
+    assert len(os.listdir(tmp_path)) == len(serial + parallel)
+
 def test_pangonet_filter():
-    ...
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    pango_filter = pango.filter(["XE", "B.1.1.529", "BA.1", "BA.2", "BA.2.75"])
+    assert list(pango_filter.network) == ["B.1.1.529", "BA.1", "BA.2", "BA.2.75", "XE"]
+    assert pango_filter.network["XE"]["ancestors"] == ["BA.1", "B.1.1.529", "BA.2"]
+    assert pango_filter.get_children("BA.2") == ["BA.2.75", "XE"]
+    assert list(pango_filter.recombinants) == ["XE"]
+    # The unfiltered network is left untouched, and shares its aliases with the filtered one
+    assert len(pango.network["BA.2"]["children"]) > 2
+    assert pango_filter.aliases is pango.aliases
 
 def test_pangonet_get_ancestors():
     ...
 
+def test_pangonet_get_ancestry_matrix():
+    pytest.importorskip("scipy")
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    matrix, lineages, depth = pango.get_ancestry_matrix()
+    assert list(lineages) == list(pango.network)
+    assert depth[pango.graph.ids["JN.1"]] == pango.network["JN.1"]["depth"]
+    indptr, indices = matrix.indptr, matrix.indices
+    row = lambda lineage: [lineages[i] for i in indices[indptr[pango.graph.ids[lineage]]:indptr[pango.graph.ids[lineage] + 1]]]
+    assert sorted(row("XE")) == sorted(pango.get_ancestors("XE"))
+    assert len(indices) == sum(len(info["ancestors"]) for info in pango.network.values())
+    matrix, lineages, depth = pango.get_ancestry_matrix(include_self=True, format="coo")
+    rows, columns = matrix.row, matrix.col
+    assert len(rows) == len(columns) == len(indices) + len(lineages)
+    # Filtered networks have no index, rows come from their ancestors lists
+    filtered = pango.filter(["BA.2", "BA.2.10", "XBB", "XBB.1.5"])
+    matrix, lineages, depth = filtered.get_ancestry_matrix()
+    indptr, indices = matrix.indptr, matrix.indices
+    row = lambda lineage: [lineages[i] for i in indices[indptr[filtered.graph.ids[lineage]]:indptr[filtered.graph.ids[lineage] + 1]]]
+    assert sorted(row("XBB.1.5")) == sorted(filtered.network["XBB.1.5"]["ancestors"]) == ["BA.2", "BA.2.10", "XBB"]
+    with pytest.raises(ValueError):
+        pango.get_ancestry_matrix(format="dense")
+
 def test_pangonet_get_children():
     pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
     assert pango.get_children("JN.1.1") == ['JN.1.1.1', 'JN.1.1.2', 'JN.1.1.3', 'JN.1.1.4', 'JN.1.1.5', 'JN.1.1.6', 'JN.1.1.7', 'JN.1.1.8', 'JN.1.1.9', 'JN.1.1.10', 'XDN', 'XDR']
@@ -37,6 +290,13 @@ def test_pangonet_get_children():
 def test_pangonet_get_descendants():
     ...
 
+def test_pangonet_get_description():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes, descriptions=True)
+    assert pango.get_description("A.1") == "USA lineage"
+    assert pango.get_description("JN.1").startswith("Alias of B.1.1.529.2.86.1.1, S:L455S")
+    with pytest.raises(ValueError):
+        PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes).get_description("A.1")
+
 def test_pangonet_get_mrca():
     pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
     assert pango.get_mrca(["BA.1", "BA.2", "BC.1"]) == ["B.1.1.529"]
@@ -44,6 +304,18 @@ def test_pangonet_get_mrca():
     assert pango.get_mrca(["XE", "XG"]) == ["BA.1", "BA.2"]
     assert pango.get_mrca(["BA.1", "BA.1.1"]) == ["BA.1"]
     assert pango.get_mrca(["XBB.1", "XBL"]) == ["XBB.1"]
+    # Aliased recombinant descendants are deeper than their parents
+    assert pango.get_mrca(["HZ.2"]) == ["HZ.2"]
+    assert pango.get_mrca(["HZ.2", "XBB.1.5.68"]) == ["XBB.1.5.68"]
+
+def test_pangonet_get_mrca_many():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    groups = [["BA.1", "BA.2", "BC.1"], ["BA.1.2", "XD"], ["XE", "XG"], ["BA.1", "BA.1.1"], ["XBB.1", "XBL"], ["BQ.1"], []]
+    assert pango.get_mrca_many(groups) == [["B.1.1.529"], ["BA.1"], ["BA.1", "BA.2"], ["BA.1"], ["XBB.1"], ["BQ.1"], []]
+    # Matches the counting implementation on a custom network, including repeated lineages
+    groups = [["BA.1", "BA.1"], ["XBB", "XBB", "XDB"], ["XDB", "XBL", "JN.1"], ["XE", "XG", "XBB.1.5", "BA.2.75", "XDB"]]
+    network = pango.network.copy()
+    assert pango.get_mrca_many(groups) == [pango.get_mrca(group, network=network) for group in groups]
 
 def test_pangonet_get_parents():
     pango = PangoNet().build(alias_key=new_alias_key, lineage_notes=new_lineage_notes)
@@ -85,17 +357,359 @@ def test_pangonet_get_paths():
 def test_pangonet_get_recombinants():
     ...
 
-def test_pangonet_to_dot():
-    ...
+def test_pangonet_get_topological_order():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    order = pango.get_topological_order()
+    position = {lineage:i for i,lineage in enumerate(order)}
+    assert order[0] == "root"
+    assert position["XBB"] > position["BJ.1"]
+    assert position["XBB"] > position["BM.1.1.1"]
 
-def test_pangonet_to_json():
-    ...
+def test_pangonet_is_ancestor():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    assert pango.is_ancestor("B.1.1.529", "BA.1")
+    assert pango.is_ancestor("B.1.1.529", "B.1.1.529.1")
+    assert not pango.is_ancestor("BA.1", "BA.1")
+    assert not pango.is_ancestor("BA.1", "B.1.1.529")
+    assert not pango.is_ancestor("BA.1", "BA.2")
+    # Recombinants reach both parental lineages, even recursively
+    assert pango.is_ancestor("BA.1", "XE")
+    assert pango.is_ancestor("BA.2", "XE")
+    assert pango.is_ancestor("BM.1.1.1", "XBL")
+    assert pango.is_ancestor("BA.2.75", "XBL")
+    assert not pango.is_ancestor("BA.5", "XBL")
+    # Every answer matches the ancestors list
+    for lineage in ["XDB", "XBL", "JN.1.1", "BQ.1"]:
+        ancestors = pango.network[lineage]["ancestors"]
+        assert [l for l in pango.lineages if pango.is_ancestor(l, lineage)] == [l for l in pango.lineages if l in ancestors]
+
+def test_pangonet_is_descendant():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    assert pango.is_descendant("BA.1", "B.1.1.529")
+    assert pango.is_descendant("XDB", "BJ.1")
+    assert not pango.is_descendant("B.1.1.529", "BA.1")
+    assert not pango.is_descendant("XDB", "BA.1")
+
+def test_pangonet_iter_lineage_notes():
+    pango = PangoNet()
+    lineage_notes_iter = pango.iter_lineage_notes(lineage_notes)
+    assert next(lineage_notes_iter)[0] == "A"
+    lineage, offset = next(lineage_notes_iter)
+    with open(lineage_notes, "rb") as infile:
+        infile.seek(offset)
+        assert infile.readline() == b"A.1\tUSA lineage\n"
+    assert len(pango.parse_lineages(lineage_notes)) < len(list(pango.iter_lineage_notes(lineage_notes)))
+    # Line offsets are only kept for descriptions
+    assert pango.descriptions is None
+    pango.parse_lineages(lineage_notes, descriptions=True)
+    assert pango.descriptions[1]["A.1"] == offset
+
+def test_pangonet_iter_paths():
+    pango = PangoNet().build(alias_key=new_alias_key, lineage_notes=new_lineage_notes)
+    paths = pango.iter_paths(start="B.1.1.529", end="XDB")
+    assert next(paths) == ['B.1.1.529', 'BA.2', 'BA.2.10', 'BA.2.10.1', 'BJ.1', 'XBB', 'XBB.1', 'XBB.1.16', 'XBB.1.16.19', 'XDB']
+    assert list(pango.iter_paths(start="XBL", end="B.1.1", limit=2)) == pango.get_paths(start="XBL", end="B.1.1")[:2]
+    assert list(pango.iter_paths(start="BA.1", end="BA.2")) == []
+
+def test_pangonet_load(tmp_path):
+    snapshot = os.path.join(tmp_path, "pango.snapshot")
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    pango.save(snapshot)
+    loaded = PangoNet().load(snapshot, alias_key=alias_key, lineage_notes=lineage_notes)
+    assert loaded.network == pango.network
+    assert loaded.aliases == pango.aliases
+    assert loaded.recombinants == pango.recombinants
+    assert loaded.get_mrca(["XE", "XG"]) == ["BA.1", "BA.2"]
+    assert loaded.is_ancestor("BM.1.1.1", "XBL")
+    compact = PangoNet().load(snapshot, compact=True)
+    assert compact.to_newick() == pango.to_newick()
+    # A snapshot built from other input files is rejected
+    with pytest.raises(ValueError):
+        PangoNet().load(snapshot, alias_key=alias_key, lineage_notes=alias_key)
+
+def test_pangonet_load_mmap(tmp_path):
+    path = os.path.join(tmp_path, "pango.map")
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    pango.save_mmap(path)
+    mapped = PangoNet().load_mmap(path)
+    assert list(mapped.network) == list(pango.network)
+    for lineage in ["root", "BA.1", "B.1.1.529", "XBB", "XBL", "JN.1.1"]:
+        assert dict(mapped.network[lineage]) == pango.network[lineage]
+    assert "B.1.1.529.1" not in mapped.network
+    assert mapped.resolve("B.1.1.529.2.86.1.1") == mapped.resolve("BA.2.86.1.1") == "JN.1"
+    assert mapped.get_children("B.1.1.529.1.1.1") == ["BC.1", "BC.2"]
+    assert "BA.1" in mapped.network
+    assert "ZZZ.1" not in mapped.network
+    assert mapped.get_parents("XBB") == ['BJ.1', 'BM.1.1.1']
+    assert mapped.get_descendants("KP.1") == pango.get_descendants("KP.1")
+    assert mapped.get_mrca(["XE", "XG"]) == ["BA.1", "BA.2"]
+    assert mapped.compress("B.1.1.529.1.1.1.4.5") == "BC.4.5"
+    assert mapped.to_newick() == pango.to_newick()
+
+def test_pangonet_profile(tmp_path):
+    profile = Profile()
+    pango = PangoNet(profile=profile).build(alias_key=alias_key, lineage_notes=lineage_notes, snapshot=os.path.join(tmp_path, "pango.snapshot"))
+    with pango.stage("newick") as stage:
+        pango.to_newick()
+        stage["network"] = pango.network
+    stages = {s["stage"]:s for s in profile.to_dict()["stages"]}
+    assert list(stages) == ["parse", "aliases", "recombinants", "parents", "children", "closure", "depth", "names", "compact", "index", "save", "newick"]
+    assert stages["newick"]["nodes"] == stages["compact"]["nodes"] == len(pango.lineages) + 1
+    assert stages["newick"]["edges"] == sum(len(pango.get_parents(l)) for l in pango.lineages)
+    assert all(s["seconds"] >= 0 and s["peak_memory"] > 0 for s in stages.values())
+    # Loading the snapshot is a single stage, and the memory can be left out
+    profile = Profile(memory=False)
+    PangoNet(profile=profile).build(alias_key=alias_key, lineage_notes=lineage_notes, snapshot=os.path.join(tmp_path, "pango.snapshot"))
+    assert [s["stage"] for s in profile.stages] == ["load"]
+    assert "peak_memory" not in profile.stages[0]
+    # Without a profile, stages are not recorded
+    with PangoNet().stage("newick") as stage:
+        stage["network"] = pango.network
+
+def test_pangonet_resolve():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    assert pango.resolve("BA.1")        == "BA.1"
+    assert pango.resolve("B.1.1.529.1") == "BA.1"
+    assert pango.resolve("BA.2.86.1.1") == "JN.1"
+    assert pango.resolve("Unassigned")  == None
+    # Queries accept the same names as resolve
+    assert pango.get_parents("BA.2.86.1.1") == pango.get_parents("JN.1") == ["BA.2.86.1"]
+    assert pango.get_children("BA.2.86.1.1")[:2] == ["JN.1.1", "JN.1.2"]
+    assert pango.get_ancestors("BA.2.86.1.1") == pango.get_ancestors("JN.1")
+    assert pango.get_mrca(["BA.2.86.1.1.1", "JN.1.2"]) == ["JN.1"]
+    assert pango.is_ancestor("BA.2.86.1.1", "JN.1.1")
+    assert pango.shortest_path(start="BA.2.86.1.1.1", end="BA.2.86.1") == ["JN.1.1", "JN.1", "BA.2.86.1"]
+    assert pango.filter(["BA.2.86.1.1", "JN.1.1"]).lineages == ["JN.1", "JN.1.1"]
+
+def test_pangonet_rollup():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    # KP.2 is also given uncompressed, and XDB descends from BA.2 through both parents of XBB
+    lineages = ["JN.1", "JN.1.1", "KP.2", "B.1.1.529.2.86.1.1.11.1.2", "BA.1", "XDB", "unknown"]
+    rollup = pango.rollup(lineages, clades=["JN.1", "BA.2", "XBB", "root"])
+    assert rollup == {"JN.1": 4, "BA.2": 5, "XBB": 1, "root": 6}
+    rollup = pango.rollup(lineages, clades=["JN.1"], exclude=["KP.2"])
+    assert rollup == {"JN.1": 2}
+    rollup = pango.rollup(lineages, weights=[1, 1, 1, 1, 4, 2, 1], clades=["BA.1", "root"], frequency=True)
+    assert rollup == {"BA.1": 0.4, "root": 1.0}
+    dates = ["2024-02", "2024-01", "2024-02", "2024-02", "2024-01", "2024-01", "2024-01"]
+    rollup = pango.rollup(lineages, dates=dates, clades=["JN.1"])
+    assert rollup == {"2024-01": {"JN.1": 1}, "2024-02": {"JN.1": 3}}
+
+def test_pangonet_rollup_ids():
+    np = pytest.importorskip("numpy")
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    lineages = ["JN.1", "JN.1.1", "KP.2", "BA.1", "XDB"]
+    ids = np.array([pango.graph.ids[lineage] for lineage in lineages])
+    assert pango.rollup(ids) == pango.rollup(lineages)
+    dates = np.array(["2024-01-01", "2024-02-01", "2024-02-01", "2024-01-01", "2024-01-01"], dtype="datetime64[D]")
+    rollup = pango.rollup(ids, weights=np.full(len(ids), 0.5), dates=dates, clades=["JN.1"])
+    assert list(rollup.values()) == [{"JN.1": 0.5}, {"JN.1": 1.0}]
+
+def test_pangonet_save(tmp_path):
+    snapshot = os.path.join(tmp_path, "pango.snapshot")
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes, snapshot=snapshot)
+    assert os.path.exists(snapshot)
+    # The second build reuses the snapshot
+    modified = os.path.getmtime(snapshot)
+    cached = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes, snapshot=snapshot)
+    assert os.path.getmtime(snapshot) == modified
+    assert cached.network == pango.network
+    with pytest.raises(ValueError):
+        PangoNet().save(snapshot)
+
+def test_pangonet_save_mmap(tmp_path):
+    path = os.path.join(tmp_path, "pango.map")
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    assert pango.save_mmap(path) == path
+    with open(path, "rb") as infile:
+        assert infile.read(8) == b"PANGOMAP"
+    # A memory-mapped network can be saved again, in either format
+    mapped = PangoNet().load_mmap(path)
+    remapped = PangoNet().load_mmap(mapped.save_mmap(os.path.join(tmp_path, "remapped.map")))
+    assert remapped.to_newick() == pango.to_newick()
+    assert remapped.resolve("BA.2.86.1.1") == "JN.1"
+    loaded = PangoNet().load(mapped.save(os.path.join(tmp_path, "pango.snapshot")))
+    assert loaded.network == pango.network
+    with pytest.raises(ValueError):
+        PangoNet().save_mmap(path)
+
+def test_pangonet_search(tmp_path):
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    assert pango.search("BA.2") == {"BA.2": "B.1.1.529.2"}
+    assert pango.search("nope") == {}
+    # Aliased descendants are found through their uncompressed names
+    search = pango.search("BA.2.*")
+    assert "BA.2" not in search and search["JN.1"] == "B.1.1.529.2.86.1.1" and "XBB" not in search
+    assert list(pango.search("JN.1*", limit=3)) == ["JN.1", "JN.1.1", "JN.1.1.1"]
+    assert "JN.10" in pango.search("JN.1*") and "JN.10" not in pango.search("JN.1.*")
+    assert list(pango.search("KP.*")) == list(pango.search("B.1.1.529.2.86.1.1.11.1.*"))
+    assert list(pango.search("KP*")) == ["JN.1.11.1"] + list(pango.search("KP.*"))
+    assert set(pango.search("*")) == set(pango.lineages)
+    # Recombinants are included with their descendants, matching get_descendants
+    search = pango.search("BA.2.*", recombinants=True)
+    assert "XBB" in search and "XBL" in search
+    assert set(search) == set(pango.get_descendants("BA.2"))
+    with pytest.raises(ValueError):
+        pango.search("BA.*.1")
+    # Filtered networks only search their own lineages
+    filtered = pango.filter(["BA.1", "BA.2"])
+    assert filtered.search("BA.*") == {"BA.1": "B.1.1.529.1", "BA.2": "B.1.1.529.2"}
+    # Memory-mapped networks create the trie on the first search
+    pango.save_mmap(os.path.join(tmp_path, "pango.map"))
+    mapped = PangoNet().load_mmap(os.path.join(tmp_path, "pango.map"))
+    assert mapped.search("BA.2.*", recombinants=True) == search
+
+def test_pangonet_serve(tmp_path):
+    import json, shutil, threading, urllib.request
+    from http.server import ThreadingHTTPServer
+    service_lineage_notes = os.path.join(tmp_path, "lineage_notes.txt")
+    shutil.copy(lineage_notes, service_lineage_notes)
+    service = QueryService(alias_key=alias_key, lineage_notes=service_lineage_notes)
+
+    assert service.query("mrca", {"lineages": "XE,XG"}) == ["BA.1", "BA.2"]
+    assert service.query("parents", {"lineage": "B.1.1.529.2.86.1.1"}) == ["BA.2.86.1"]
+    assert service.batch([{"query": "uncompress", "lineage": "JN.1"}, {"query": "children", "lineage": "nope"}]) == [
+        {"result": "B.1.1.529.2.86.1.1"}, {"error": "Unknown lineage: nope"}
+    ]
+    # Only KeyError messages lose their quotes, and bad parameters are errors too
+    answers = service.batch([5, {"query": "search", "pattern": "BA.2", "limit": [1]}])
+    assert answers[0] == {"error": "Query is not a JSON object: 5"}
+    assert answers[1]["error"].startswith("int() argument") and answers[1]["error"].endswith("not 'list'")
+    # Results are copies, changing them doesn't change the cache or the network
+    service.query("children", {"lineage": "KP.2"}).append("KP.2.99")
+    assert "KP.2.99" not in service.query("children", {"lineage": "KP.2"})
+    assert "KP.2.99" not in service.pango.get_children("KP.2")
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), QueryHandler)
+    httpd.service = service
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    with urllib.request.urlopen(f"{url}/paths?start=XE&end=B.1.1.529") as response:
+        assert json.load(response)["result"] == [["XE", "BA.1", "B.1.1.529"], ["XE", "BA.2", "B.1.1.529"]]
+    with urllib.request.urlopen(f"{url}/search?pattern=JN.1*&limit=2") as response:
+        assert json.load(response)["result"] == {"JN.1": "B.1.1.529.2.86.1.1", "JN.1.1": "B.1.1.529.2.86.1.1.1"}
+    request = urllib.request.Request(url, data=json.dumps([{"query": "compress", "lineage": "B.1.1.529.2.86.1.1"}]).encode())
+    with urllib.request.urlopen(request) as response:
+        assert json.load(response) == [{"result": "JN.1"}]
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(f"{url}/ancestors?lineage=nope")
+    assert error.value.code == 404 and json.load(error.value) == {"error": "Unknown lineage: nope"}
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(f"{url}/search?pattern=BA.2&limit=ten")
+    assert error.value.code == 400
+
+    # New designations are swapped in, and the cached results are dropped
+    assert service.refresh() == False
+    assert service.query("children", {"lineage": "KP.2"})[-1] == "KP.2.17"
+    with open(service_lineage_notes, "a") as outfile:
+        outfile.write("KP.2.18\tNew lineage\n")
+    os.utime(service_lineage_notes, ns=(0, 0))
+    assert service.refresh() == True
+    assert service.query("children", {"lineage": "KP.2"})[-1] == "KP.2.18"
+    httpd.shutdown()
+    httpd.server_close()
+
+def test_pangonet_serve_without_unix_sockets(monkeypatch):
+    import socketserver, subprocess, sys
+    # The module imports where Unix sockets don't exist (ex. Windows)
+    path = sys.modules[PangoNet.__module__].__file__
+    script = f"import socket; del socket.AF_UNIX; import runpy; runpy.run_path({path!r}, run_name='pangonet')"
+    subprocess.run([sys.executable, "-c", script], check=True)
+    # And serving on a Unix socket there is an error
+    pangonet = sys.modules[PangoNet.__module__]
+    monkeypatch.delattr(socketserver, "UnixStreamServer")
+    with pytest.raises(ValueError):
+        pangonet.serve(None, socket="pangonet.sock")
+
+def test_pangonet_shortest_path():
+    pango = PangoNet().build(alias_key=new_alias_key, lineage_notes=new_lineage_notes)
+    assert pango.shortest_path(start="BA.1", end="BA.1")      == ["BA.1"]
+    assert pango.shortest_path(start="XBL",  end="B.1.1")     == ['XBL', 'BA.2.75', 'BA.2', 'B.1.1.529', 'B.1.1']
+    assert pango.shortest_path(start="B.1.1.529", end="XDB")  == ['B.1.1.529', 'BA.2', 'BA.2.10', 'BA.2.10.1', 'BJ.1', 'XBB', 'XDB']
+    assert pango.shortest_path(start="BA.1", end="BA.2")      == []
+
+def test_pangonet_to_dot(tmp_path):
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    dot_path = os.path.join(tmp_path, "pango.dot")
+    with open(dot_path, "w") as outfile:
+        assert pango.to_dot(file=outfile) is None
+    with open(dot_path) as infile:
+        assert infile.read() == pango.to_dot()
+
+def test_pangonet_to_json(tmp_path):
+    import gzip, json
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    assert pango.to_json() == json.dumps(pango.network, indent=4)
+    compact = json.loads(pango.to_json(compact=True))
+    assert compact["C.1"]["parents"] == "B.1.1.1"
+    assert compact["C.1"]["children"] == "C.1.1, C.1.2"
+    # Each lineage is exported once, under its compressed name
+    assert "B.1.1.1.1" not in compact
+    assert len(compact) == len(pango.lineages) + 1
+    json_path = os.path.join(tmp_path, "pango.json.gz")
+    with gzip.open(json_path, "wt") as outfile:
+        pango.to_json(file=outfile)
+    with gzip.open(json_path, "rt") as infile:
+        assert infile.read() == pango.to_json()
 
 def test_pangonet_to_mermaid():
     ...
 
-def test_pangonet_to_newick():
-    ...
+def test_pangonet_to_newick(tmp_path):
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    pango_filter = pango.filter(["B.1.1.529", "BA.1", "BA.2", "XE"])
+    assert pango_filter.to_newick(extended=True)  == "((XE#XE:1)BA.1:1,(XE#XE:1)BA.2:1)B.1.1.529:0;"
+    newick_path = os.path.join(tmp_path, "pango.nwk")
+    with open(newick_path, "w") as outfile:
+        assert pango.to_newick(extended=False, file=outfile) is None
+    with open(newick_path) as infile:
+        assert infile.read() == pango.to_newick(extended=False)
+    # Deep networks are written without recursion
+    lineages = [f"A.{i}" for i in range(5000)]
+    deep = PangoNet()
+    deep.network = {
+        lineage: {"parents": lineages[i-1:i], "children": lineages[i+1:i+2], "depth": i}
+        for i,lineage in enumerate(lineages)
+    }
+    assert deep.to_newick().startswith("(" * 4999 + "A.4999:1)A.4998:1)")
+    assert deep.to_newick().endswith(")A.0:0;")
+
+def test_pangonet_to_parquet(tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    path = pango.to_parquet(os.path.join(tmp_path, "pango.parquet"))
+    nodes = pq.read_table(os.path.join(path, "nodes.parquet")).to_pydict()
+    assert nodes["lineage"] == list(pango.network)
+    assert nodes["recombinant"][nodes["lineage"].index("XBB")] == True
+    edges = pq.read_table(os.path.join(path, "edges.parquet")).to_pydict()
+    assert [p for p,l in zip(edges["parent"], edges["lineage"]) if l == "XBB"] == ["BJ.1", "BM.1.1.1"]
+    closure = pq.read_table(os.path.join(path, "closure.parquet")).to_pydict()
+    assert sorted(l for a,l in zip(closure["ancestor"], closure["lineage"]) if a == "KP.1") == sorted(pango.get_descendants("KP.1"))
+    # Without the closure, and the same tables from a compact network
+    assert list(pango.to_arrow(closure=False)) == ["nodes", "edges"]
+    compact = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes, compact=True)
+    assert all(table.equals(compact.to_arrow()[name]) for name,table in pango.to_arrow().items())
+
+def test_pangonet_to_sqlite(tmp_path):
+    import sqlite3
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    path = pango.to_sqlite(os.path.join(tmp_path, "pango.sqlite"))
+    connection = sqlite3.connect(path)
+    assert connection.execute("SELECT uncompressed, depth FROM nodes WHERE lineage = 'JN.1'").fetchone() == ("B.1.1.529.2.86.1.1", 8)
+    assert connection.execute("SELECT count(*) FROM nodes").fetchone()[0] == len(pango.network)
+    assert connection.execute("SELECT parent FROM edges WHERE lineage = 'XBB' ORDER BY parent").fetchall() == [("BJ.1",), ("BM.1.1.1",)]
+    descendants = connection.execute("SELECT lineage FROM closure WHERE ancestor = 'BA.2'").fetchall()
+    assert sorted(l for l, in descendants) == sorted(pango.get_descendants("BA.2"))
+    # Lineage, parent and ancestor lookups use an index
+    plan = connection.execute("EXPLAIN QUERY PLAN SELECT lineage FROM closure WHERE ancestor = 'BA.2'").fetchall()
+    assert "INDEX" in plan[0][-1]
+    connection.close()
+    # Replaced once complete, without the closure table
+    pango.to_sqlite(path, closure=False)
+    connection = sqlite3.connect(path)
+    assert [t for t, in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")] == ["nodes", "edges"]
+    connection.close()
+    assert os.listdir(tmp_path) == ["pango.sqlite"]
 
 def test_pangonet_to_table():
     ...
@@ -106,3 +720,46 @@ def test_pangonet_uncompress():
     assert pango.uncompress("BC.4.5")  == "B.1.1.529.1.1.1.4.5"
     assert pango.uncompress("XBB.1.2") == "XBB.1.2"
     assert pango.uncompress("XBC")     == "XBC"
+
+def test_pangonet_uncompress_many():
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    lineages = ["BA.1", "BC.4.5", "XBB.1.2", "BA.1"]
+    assert pango.uncompress_many(lineages) == ["B.1.1.529.1", "B.1.1.529.1.1.1.4.5", "XBB.1.2", "B.1.1.529.1"]
+
+def test_pangonet_update(tmp_path):
+    import json
+    pango = PangoNet().build(alias_key=alias_key, lineage_notes=lineage_notes)
+    # Older inputs: before KP.2.3 and its descendants were designated, with different XE parents
+    designated = ["KP.2.3"] + pango.get_descendants("KP.2.3")
+    old_lineage_notes = os.path.join(tmp_path, "lineage_notes.txt")
+    with open(lineage_notes) as infile, open(old_lineage_notes, "w") as outfile:
+        outfile.writelines(line for line in infile if line.split("\t")[0] not in designated)
+    old_alias_key = os.path.join(tmp_path, "alias_key.json")
+    with open(alias_key) as infile, open(old_alias_key, "w") as outfile:
+        aliases = json.load(infile)
+        aliases["XE"] = ["BA.1", "BA.2.3"]
+        json.dump(aliases, outfile)
+
+    updated = PangoNet().build(alias_key=old_alias_key, lineage_notes=old_lineage_notes)
+    old_network = updated.network
+    old_xe = old_network["XE"]
+    report = updated.update(alias_key=alias_key, lineage_notes=lineage_notes)
+    assert report == {"added": designated, "withdrawn": [], "relinked": ["XE"]}
+    assert list(updated.network) == list(pango.network)
+    assert updated.network == pango.network
+    assert updated.get_mrca(["XE", "BA.2.3"]) == ["BA.2"]
+    # The old network is left as it was
+    assert old_network["XE"] is old_xe and old_xe["parents"] == ["BA.1", "BA.2.3"]
+
+    # And back again, withdrawing the newer lineages
+    report = updated.update(alias_key=old_alias_key, lineage_notes=old_lineage_notes)
+    assert report == {"added": [], "withdrawn": designated, "relinked": ["XE"]}
+    assert updated.network == old_network
+
+def test_pangonet_write_output():
+    import io
+    pango  = PangoNet()
+    stream = io.StringIO()
+    assert pango.write_output(["a", "b", "c"]) == "a\nb\nc"
+    pango.write_output(iter(["a", "b", "c"]), file=stream, sep=", ")
+    assert stream.getvalue() == "a, b, c"